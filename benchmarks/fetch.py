@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+#
+# Fetch throughput benchmark for the acquire settings.
+#
+# A local HTTP server stands in for the mirror: it serves fake archives
+# on one or more loopback addresses (127.0.0.1, 127.0.0.2, ...), adding
+# a fixed latency to simulate the round trip time. Pipelined requests
+# (already received when the previous response has been sent) don't pay
+# the latency, as it would happen on a real link.
+# The archives are then downloaded with APT's acquire system, once for
+# every set of acquire settings (see channels.acquire), in a fresh
+# interpreter, and the throughput is reported.
+#
+# Usage: python3 benchmarks/fetch.py [-f FILES] [-s SIZE] [-l LATENCY] [-H HOSTS] [settings ...]
+# where settings is a comma separated list of name=value acquire settings,
+# e.g. "pipeline-depth=10,queue-mode=access".
+#
+
+import os
+
+import sys
+
+import json
+
+import time
+
+import argparse
+
+import tempfile
+
+import select
+
+import threading
+
+import subprocess
+
+import http.server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SETTINGS = [
+	"",
+	"pipeline-depth=0",
+	"pipeline-depth=10",
+	"pipeline-depth=50",
+	"queue-mode=access",
+	"queue-host-limit=1",
+]
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	Serves fake archives of the requested size: /<size>/<name>.deb
+	"""
+	
+	protocol_version = "HTTP/1.1"
+	
+	# Unbuffered, so that select() tells if the next request is there
+	rbufsize = 0
+	
+	latency = 0
+	
+	def setup(self):
+		"""
+		Sets up the connection.
+		"""
+		
+		super().setup()
+		
+		self.pipelined = False
+	
+	def do_GET(self):
+		"""
+		Handles a GET request.
+		"""
+		
+		try:
+			size = int(self.path.split("/")[1])
+		except (IndexError, ValueError):
+			self.send_error(404)
+			return
+		
+		if not self.pipelined:
+			# Round trip
+			time.sleep(self.latency)
+		
+		self.send_response(200)
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(size))
+		self.end_headers()
+		
+		chunk = b"\0" * 65536
+		while size > 0:
+			self.wfile.write(chunk[:size])
+			size -= len(chunk)
+		
+		self.pipelined = bool(select.select([self.connection], [], [], 0)[0])
+	
+	def log_message(self, format, *args):
+		"""
+		Silences the request log.
+		"""
+		
+		pass
+
+def start_mirror(hosts, latency):
+	"""
+	Starts the mirror stand-in on the given number of loopback addresses,
+	and returns the list of base URIs.
+	"""
+	
+	MirrorHandler.latency = latency
+	
+	uris = []
+	for i in range(hosts):
+		server = http.server.ThreadingHTTPServer(("127.0.0.%d" % (i + 1), 0), MirrorHandler)
+		server.daemon_threads = True
+		
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		
+		uris.append("http://%s:%d" % server.server_address)
+	
+	return uris
+
+def child(uris, settings):
+	"""
+	Fetches the given URIs with the given acquire settings, and prints
+	a JSON report.
+	"""
+	
+	sys.path.insert(0, ROOT)
+	
+	import apt_pkg
+	
+	from channels.acquire import AcquireSettings, parse_options
+	
+	apt_pkg.init()
+	
+	with tempfile.TemporaryDirectory() as directory:
+		acquire_settings = AcquireSettings(path=os.path.join(directory, "acquire.conf"))
+		
+		with acquire_settings.override(parse_options(settings)):
+			acquire = apt_pkg.Acquire()
+			items = [
+				apt_pkg.AcquireFile(acquire, uri, destdir=directory)
+				for uri in uris
+			]
+			
+			start = time.perf_counter()
+			acquire.run()
+			elapsed = time.perf_counter() - start
+		
+		failed = len([item for item in items if item.status != item.STAT_DONE])
+	
+	print(json.dumps({
+		"elapsed": elapsed,
+		"bytes": acquire.fetch_needed,
+		"failed": failed
+	}))
+
+def run(uris, settings):
+	"""
+	Runs a fetch in a fresh interpreter, and returns its report.
+	"""
+	
+	output = subprocess.check_output(
+		[sys.executable, os.path.abspath(__file__), "--child", ",".join(settings)] + uris,
+		stderr=subprocess.DEVNULL
+	)
+	
+	return json.loads(output.decode("utf-8"))
+
+if __name__ == "__main__":
+	
+	if len(sys.argv) > 1 and sys.argv[1] == "--child":
+		child(sys.argv[3:], [x for x in sys.argv[2].split(",") if x])
+		sys.exit(0)
+	
+	parser = argparse.ArgumentParser(description="channels fetch benchmark")
+	parser.add_argument(
+		"-f", "--files",
+		type=int,
+		default=200,
+		help="number of archives to fetch (default: 200)"
+	)
+	parser.add_argument(
+		"-s", "--size",
+		type=int,
+		default=64 * 1024,
+		help="size of every archive, in bytes (default: 65536)"
+	)
+	parser.add_argument(
+		"-l", "--latency",
+		type=float,
+		default=0.02,
+		help="latency added to every request, in seconds (default: 0.02)"
+	)
+	parser.add_argument(
+		"-H", "--hosts",
+		type=int,
+		default=2,
+		help="number of mirror hosts (default: 2)"
+	)
+	parser.add_argument(
+		"settings",
+		nargs="*",
+		help="comma separated acquire settings to benchmark (e.g. pipeline-depth=10,queue-mode=access)"
+	)
+	args = parser.parse_args()
+	
+	mirrors = start_mirror(args.hosts, args.latency)
+	
+	uris = [
+		"%s/%d/archive%d.deb" % (mirrors[i % len(mirrors)], args.size, i)
+		for i in range(args.files)
+	]
+	
+	print("%-40s %10s %12s %8s" % ("settings", "time", "throughput", "failed"))
+	
+	for settings in (args.settings or DEFAULT_SETTINGS):
+		report = run(uris, [x for x in settings.split(",") if x])
+		print(
+			"%-40s %9.2fs %10.1fMB/s %8d" % (
+				settings or "(apt defaults)",
+				report["elapsed"],
+				args.files * args.size / report["elapsed"] / 1024 / 1024,
+				report["failed"]
+			)
+		)
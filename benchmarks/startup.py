@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+#
+# Startup benchmark for the command-line frontend.
+#
+# Every command is executed in a fresh interpreter, several times.
+# For every run we record the wall time and which bootstrap stages
+# (see channels.common.LazyStage) have been built.
+# Every command is also run in "eager" mode, where every stage is built
+# before the command is executed (as channels.common did before stages
+# were made lazy): the difference is what each command saves.
+#
+# Usage: python3 benchmarks/startup.py [-n RUNS] [command ...]
+#
+
+import os
+
+import sys
+
+import json
+
+import time
+
+import argparse
+
+import subprocess
+
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_COMMANDS = [
+	["show"],
+	["list"],
+	["get-enabled", "semplice-current"],
+	["list-components", "semplice-current"],
+	["list-providers"],
+	["what-provides", "semplice"],
+]
+
+def child(command, eager=False):
+	"""
+	Executes the given command in the current interpreter and prints
+	a JSON report on the original stdout.
+	
+	If `eager` is True, every bootstrap stage is built beforehand.
+	"""
+	
+	import runpy
+	import io
+	
+	sys.path.insert(0, ROOT)
+	
+	report = sys.stdout
+	sys.stdout = io.StringIO()
+	
+	start = time.perf_counter()
+	
+	import channels.common
+	
+	try:
+		if eager:
+			for stage in channels.common.STAGES:
+				stage.get()
+		
+		sys.argv = [os.path.join(ROOT, "channels.py")] + command
+		runpy.run_path(sys.argv[0], run_name="__main__")
+	except SystemExit:
+		pass
+	
+	elapsed = time.perf_counter() - start
+	
+	report.write(json.dumps({
+		"elapsed": elapsed,
+		"stages": [stage._name for stage in channels.common.STAGES if stage.built]
+	}))
+
+def run(command, runs, eager=False):
+	"""
+	Runs the given command `runs` times, and returns a tuple
+	containing the median wall time and the built stages.
+	"""
+	
+	times = []
+	stages = []
+	
+	for i in range(runs):
+		output = subprocess.check_output(
+			[sys.executable, os.path.abspath(__file__), "--eager-child" if eager else "--child"] + command,
+			stderr=subprocess.DEVNULL
+		)
+		report = json.loads(output.decode("utf-8"))
+		
+		times.append(report["elapsed"])
+		stages = report["stages"]
+	
+	return statistics.median(times), stages
+
+if __name__ == "__main__":
+	
+	if len(sys.argv) > 1 and sys.argv[1] in ("--child", "--eager-child"):
+		child(sys.argv[2:], eager=(sys.argv[1] == "--eager-child"))
+		sys.exit(0)
+	
+	parser = argparse.ArgumentParser(description="channels startup benchmark")
+	parser.add_argument(
+		"-n", "--runs",
+		type=int,
+		default=5,
+		help="number of runs for every command (default: 5)"
+	)
+	parser.add_argument(
+		"command",
+		nargs="*",
+		help="command to benchmark (as a single quoted string)"
+	)
+	args = parser.parse_args()
+	
+	commands = [x.split() for x in args.command] if args.command else DEFAULT_COMMANDS
+	
+	print("%-32s %10s %10s %10s  %s" % ("command", "eager", "lazy", "saved", "stages"))
+	
+	for command in commands:
+		eager, stages = run(command, args.runs, eager=True)
+		lazy, stages = run(command, args.runs)
+		print(
+			"%-32s %8.1fms %8.1fms %8.1fms  %s" % (
+				" ".join(command),
+				eager * 1000,
+				lazy * 1000,
+				(eager - lazy) * 1000,
+				", ".join(stages) if stages else "(none)"
+			)
+		)
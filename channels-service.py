@@ -33,11 +33,15 @@ import logging.handlers
 
 import dbus
 
+from gi.repository import GLib
+
 import channels
 import channels.common
 import channels.objects
 
-from channels.dbus_common import MainLoop, BUS, is_authorized
+from channels.dbus_common import MainLoop, BUS, authorization_cache
+from channels.metrics import registry
+from channels.watcher import DiscoveryWatcher
 
 LOGPATH = "/var/log/channels/channels.log"
 
@@ -52,6 +56,14 @@ class Service(channels.objects.BaseObject):
 	"""
 	
 	path = "/org/semplicelinux/channels"
+	
+	interface_name = "org.semplicelinux.channels"
+	
+	export_properties = [
+		"connectedClients",
+		"authorizationCacheHits",
+		"authorizationCacheMisses",
+	]
 
 	def __init__(self):
 		"""
@@ -88,6 +100,96 @@ class Service(channels.objects.BaseObject):
 			
 			for obj in channels.common.get_class_actions(mod):
 				self._dbus_class_table["__main__.%s" % module]["org.semplicelinux.channels.%s" % module][obj.__name__] = obj
+		
+		# Keep the discovery cache up-to-date
+		self.watcher = DiscoveryWatcher(self._namespaces["channels"].ChannelsChanged)
+		
+		# Service-wide metrics
+		registry.gauge(
+			"channels_connected_clients",
+			"Connected clients",
+			lambda: MainLoop.client_count
+		)
+		registry.gauge(
+			"channels_job_queue_depth",
+			"Queued jobs",
+			lambda: channels.common.job_queue.depth
+		)
+		registry.gauge(
+			"channels_authorization_cache_hits",
+			"Polkit checks answered by the authorization cache",
+			lambda: authorization_cache.hits
+		)
+		registry.gauge(
+			"channels_authorization_cache_misses",
+			"Polkit checks not answered by the authorization cache",
+			lambda: authorization_cache.misses
+		)
+		
+		self.metrics_textfile = None
+	
+	def export_metrics(self, path, interval):
+		"""
+		Writes the metrics to the given node_exporter textfile every
+		`interval` seconds.
+		"""
+		
+		self.metrics_textfile = path
+		
+		self.on_metrics_export()
+		GLib.timeout_add_seconds(interval, self.on_metrics_export)
+	
+	def on_metrics_export(self):
+		"""
+		Writes the metrics to the textfile.
+		"""
+		
+		try:
+			registry.write_textfile(self.metrics_textfile)
+		except Exception as err:
+			logger.warning("Unable to write metrics to %s: %s" % (self.metrics_textfile, err))
+		
+		return True
+	
+	@channels.objects.BaseObject.outside_timeout(
+		"org.semplicelinux.channels",
+		out_signature="a{sd}",
+		sender_keyword="sender"
+	)
+	def GetMetrics(self, sender=None):
+		"""
+		Returns the metrics of the service, as a dictionary that maps
+		every sample (formatted as name{label="value",...}, like in the
+		Prometheus text format) to its value.
+		"""
+		
+		return registry.get_metrics()
+	
+	@property
+	def connectedClients(self):
+		"""
+		Returns the number of connected clients.
+		"""
+		
+		return MainLoop.client_count
+	
+	@property
+	def authorizationCacheHits(self):
+		"""
+		Returns the number of polkit checks answered by the authorization
+		cache.
+		"""
+		
+		return authorization_cache.hits
+	
+	@property
+	def authorizationCacheMisses(self):
+		"""
+		Returns the number of polkit checks not answered by the
+		authorization cache.
+		"""
+		
+		return authorization_cache.misses
 
 if __name__ == "__main__":
 
@@ -103,7 +205,25 @@ if __name__ == "__main__":
 		action="store_true",
 		help="enables debug mode"
 	)
+	parser.add_argument(
+		"--auth-cache-ttl",
+		type=int,
+		default=authorization_cache.ttl,
+		help="seconds after which a cached polkit authorization expires, 0 disables the cache (default: %(default)s)"
+	)
+	parser.add_argument(
+		"--metrics-textfile",
+		help="periodically write the metrics to the given file, for the node_exporter textfile collector"
+	)
+	parser.add_argument(
+		"--metrics-interval",
+		type=int,
+		default=15,
+		help="seconds between two writes of the metrics textfile (default: %(default)s)"
+	)
 	args = parser.parse_args()
+	
+	authorization_cache.ttl = args.auth_cache_ttl
 
 	# Set-up logging
 	if not os.path.exists("/var/log/channels/"):
@@ -138,5 +258,8 @@ if __name__ == "__main__":
 	logger.info("Starting-up the service...")
 	clss = Service()
 	
+	if args.metrics_textfile:
+		clss.export_metrics(args.metrics_textfile, args.metrics_interval)
+	
 	# Ladies and gentlemen...
 	MainLoop.run()
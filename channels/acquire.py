@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import tempfile
+
+import logging
+
+import contextlib
+
+import configparser
+
+from threading import Lock
+
+import apt_pkg
+
+logger = logging.getLogger(__name__)
+
+# Where the service settings are stored.
+# Note: not in /etc/channels, which is watched by the discovery watcher.
+SETTINGS_PATH = "/var/lib/channels/acquire.conf"
+
+SETTINGS_SECTION = "acquire"
+
+def parse_boolean(value):
+	"""
+	Converts the given value (a bool, or a string as stored in the
+	settings file) to a bool.
+	"""
+	
+	if isinstance(value, str):
+		if not value.lower() in ("true", "false", "yes", "no", "1", "0"):
+			raise ValueError(value)
+		
+		return value.lower() in ("true", "yes", "1")
+	
+	return bool(value)
+
+def to_kilobytes(value):
+	"""
+	Converts the given bytes per second to the kilobytes per second
+	wanted by APT, rounding up so that small limits don't become 0
+	(no limit).
+	"""
+	
+	return -(-value // 1024)
+
+# Supported settings.
+# name -> (type, valid values check, APT configuration keys, conversion
+# to the APT value)
+#
+# APT opens a single connection per host (or per access method, with
+# the "access" queue mode): parallelism on a single mirror comes from
+# HTTP pipelining, and the number of concurrent connections is capped
+# by the queue limit.
+SETTINGS = {
+	"pipeline-depth" : (
+		int,
+		lambda x: 0 <= x <= 1000,
+		("Acquire::http::Pipeline-Depth", "Acquire::https::Pipeline-Depth"),
+		str
+	),
+	"queue-host-limit" : (
+		int,
+		lambda x: 1 <= x <= 1000,
+		("Acquire::QueueHost::Limit",),
+		str
+	),
+	"queue-mode" : (
+		str,
+		lambda x: x in ("host", "access"),
+		("Acquire::Queue-Mode",),
+		str
+	),
+	# Bytes per second, 0 for no limit. Capped by the http(s) methods,
+	# which read it when they start, and throttled by the acquire
+	# progress (see ThrottledAcquireProgress), which reads it at every
+	# pulse so that a change applies to the running transfer too
+	"rate-limit" : (
+		int,
+		lambda x: x >= 0,
+		("Acquire::http::Dl-Limit", "Acquire::https::Dl-Limit"),
+		to_kilobytes
+	),
+	# Not an APT setting: see Updates.queue_prefetch()
+	"background-prefetch" : (
+		parse_boolean,
+		lambda x: True,
+		(),
+		str
+	),
+}
+
+def parse_setting(name, value):
+	"""
+	Validates the given setting, and returns its value converted to
+	the right type.
+	
+	Raises a ValueError if the setting is unknown or the value is not
+	valid.
+	"""
+	
+	if not name in SETTINGS:
+		raise ValueError("Unknown acquire setting %s" % name)
+	
+	type_, check, keys, to_apt = SETTINGS[name]
+	
+	try:
+		value = type_(value)
+	except (TypeError, ValueError):
+		raise ValueError("Invalid value for %s: %s" % (name, value))
+	
+	if not check(value):
+		raise ValueError("Invalid value for %s: %s" % (name, value))
+	
+	return value
+
+def parse_options(options):
+	"""
+	Parses a list of "name=value" strings (as given on the command
+	line), and returns a dictionary of validated settings.
+	"""
+	
+	result = {}
+	
+	for option in options:
+		name, sep, value = option.partition("=")
+		if not sep:
+			raise ValueError("Invalid acquire setting %s, expected name=value" % option)
+		
+		result[name.strip()] = parse_setting(name.strip(), value.strip())
+	
+	return result
+
+class AcquireSettings:
+	"""
+	The acquire settings of the service, persisted in SETTINGS_PATH.
+	
+	Unset settings use APT's own defaults. The settings are applied to
+	the APT configuration, and can be overridden for a single operation
+	with override().
+	
+	The APT configuration is process-wide: every transfer runs in
+	override(), which serializes them, so that the overrides of an
+	operation never apply to another one.
+	"""
+	
+	def __init__(self, path=SETTINGS_PATH):
+		"""
+		Initializes the class.
+		"""
+		
+		self.path = path
+		
+		self.lock = Lock()
+		
+		# Held by the running override(), for the whole operation
+		self.operation_lock = Lock()
+		
+		# name -> value
+		self.values = {}
+		
+		# name -> value, of the running override()
+		self.overrides = {}
+		
+		# key -> original value (None if unset) of the APT
+		# configuration, before we touched it
+		self.originals = {}
+		
+		self.load()
+	
+	def load(self):
+		"""
+		Loads the settings. Invalid settings are ignored.
+		"""
+		
+		parser = configparser.ConfigParser()
+		
+		try:
+			parser.read(self.path)
+		except configparser.Error as err:
+			logger.warning("Unable to load acquire settings: %s" % err)
+			return
+		
+		if not parser.has_section(SETTINGS_SECTION):
+			return
+		
+		for name, value in parser.items(SETTINGS_SECTION):
+			try:
+				self.values[name] = parse_setting(name, value)
+			except ValueError as err:
+				logger.warning("Ignoring acquire setting: %s" % err)
+	
+	def store(self):
+		"""
+		Stores the settings.
+		"""
+		
+		parser = configparser.ConfigParser()
+		parser.add_section(SETTINGS_SECTION)
+		for name, value in sorted(self.values.items()):
+			parser.set(SETTINGS_SECTION, name, str(value))
+		
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory, 0o755)
+		
+		# Write the settings atomically
+		fd, temp = tempfile.mkstemp(dir=directory, prefix=".acquire.")
+		try:
+			with os.fdopen(fd, "w") as f:
+				parser.write(f)
+			os.chmod(temp, 0o644)
+			os.replace(temp, self.path)
+		except:
+			os.remove(temp)
+			raise
+	
+	def get(self, name):
+		"""
+		Returns the value of the given setting, or None if unset.
+		"""
+		
+		return self.values.get(name)
+	
+	def effective(self, name):
+		"""
+		Returns the value of the given setting for the running
+		operation (its override() value, if any), or None if unset.
+		"""
+		
+		overrides = self.overrides
+		
+		return overrides[name] if name in overrides else self.values.get(name)
+	
+	def set(self, name, value):
+		"""
+		Sets, stores and applies the given setting.
+		
+		A None value unsets it, restoring APT's default.
+		"""
+		
+		with self.lock:
+			if value is None:
+				if not name in SETTINGS:
+					raise ValueError("Unknown acquire setting %s" % name)
+				self.values.pop(name, None)
+			else:
+				self.values[name] = parse_setting(name, value)
+			
+			# The new value applies to the running operation too
+			if name in self.overrides:
+				self.overrides = {
+					key : value
+					for key, value in self.overrides.items()
+					if key != name
+				}
+			
+			self.store()
+			self.apply()
+	
+	def _set_config(self, name, value):
+		"""
+		Sets the APT configuration keys of the given setting. A None
+		value restores the original configuration.
+		"""
+		
+		type_, check, keys, to_apt = SETTINGS[name]
+		
+		for key in keys:
+			if not key in self.originals:
+				self.originals[key] = (
+					apt_pkg.config.find(key)
+					if apt_pkg.config.exists(key) else
+					None
+				)
+			
+			if value is not None:
+				apt_pkg.config.set(key, str(to_apt(value)))
+			elif self.originals[key] is not None:
+				apt_pkg.config.set(key, self.originals[key])
+			else:
+				apt_pkg.config.clear(key)
+	
+	def apply(self):
+		"""
+		Applies the settings, and the running override() ones, to the
+		APT configuration.
+		"""
+		
+		for name in SETTINGS:
+			self._set_config(
+				name,
+				self.overrides[name] if name in self.overrides else self.values.get(name)
+			)
+	
+	@contextlib.contextmanager
+	def override(self, values=None):
+		"""
+		Context manager that runs a single operation with the given
+		settings (a dictionary, see parse_options()) on top of the
+		service ones.
+		
+		Operations wait for the running one to finish, even without
+		settings to override, so that they never run with the settings
+		of another one, nor have them reset under them.
+		"""
+		
+		with self.operation_lock:
+			if not values:
+				yield
+				return
+			
+			with self.lock:
+				overrides = {}
+				for name, value in values.items():
+					overrides[name] = parse_setting(name, value)
+					self._set_config(name, overrides[name])
+				
+				self.overrides = overrides
+			
+			try:
+				yield
+			finally:
+				with self.lock:
+					self.overrides = {}
+					self.apply()
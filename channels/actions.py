@@ -19,12 +19,13 @@
 #    Eugenio "g7" Paolantonio <me@medesimo.eu>
 #
 
-from channels.common import CURRENT_HANDLER, error
+from channels.common import CURRENT_HANDLER, error, job_queue
+from channels.metrics import registry
 
 if CURRENT_HANDLER == "DBus":
 	from channels.objects import BaseObject
-	from channels.dbus_common import is_authorized
-	from gi.repository import GObject
+	from channels.dbus_common import is_authorized_async
+	from gi.repository import GLib
 	import dbus.service
 	outside_timeout = BaseObject.outside_timeout
 
@@ -34,15 +35,174 @@ import os
 
 import types
 
+import time
+
+import threading
+
+import collections
+
 logger = logging.getLogger(__name__)
 
+# Signals emitted per second, by every object
+signals_meter = registry.meter(
+	"channels_signals_per_second",
+	"Signals emitted per second (over the last 10 seconds)"
+)
+
+# Maximum number of signals emitted in a single main loop iteration
+SIGNAL_BATCH_SIZE = 64
+
+class SignalDispatcher:
+	"""
+	Queues signal emissions and emits them, in batches, from the
+	main loop.
+	
+	Signals with a rate limit (typically progress reports) are merged:
+	if a new emission arrives while the previous one is still pending,
+	the pending one is updated with the new values. They are never
+	emitted more than once every `rate_limit` seconds.
+	
+	Other signals are always emitted, in order. Pending rate-limited
+	signals are flushed before them, so that a progress report never
+	arrives after the "done" signal that follows it.
+	"""
+	
+	def __init__(self, batch_size=SIGNAL_BATCH_SIZE):
+		"""
+		Initializes the dispatcher.
+		"""
+		
+		self.batch_size = batch_size
+		
+		self.lock = threading.Lock()
+		
+		# Entries ready to be emitted
+		self.queue = collections.deque()
+		
+		# (object, signal name) -> pending rate-limited entry
+		self.pending = {}
+		
+		# (object, signal name) -> time of the last emission
+		self.last_emission = {}
+		
+		self.source = 0
+	
+	def schedule(self):
+		"""
+		Schedules the drain of the queue. Must be called with the
+		lock held.
+		"""
+		
+		if not self.source:
+			self.source = GLib.idle_add(self.drain)
+	
+	def enqueue(self, entry):
+		"""
+		Moves a delayed entry to the queue. Must be called with the
+		lock held.
+		"""
+		
+		if entry["timeout"]:
+			GLib.source_remove(entry["timeout"])
+			entry["timeout"] = 0
+		
+		if not entry["queued"]:
+			entry["queued"] = True
+			self.queue.append(entry)
+			self.schedule()
+	
+	def on_delay_elapsed(self, entry):
+		"""
+		Fired when the delay of a rate-limited entry elapsed.
+		"""
+		
+		with self.lock:
+			entry["timeout"] = 0
+			self.enqueue(entry)
+		
+		return False
+	
+	def emit(self, func, args, kwargs, rate_limit=None):
+		"""
+		Queues an emission of the given signal function.
+		"""
+		
+		with self.lock:
+			if rate_limit is None:
+				# Flush delayed entries first. They can't be merged
+				# anymore, as that would reorder them.
+				for entry in self.pending.values():
+					self.enqueue(entry)
+				self.pending.clear()
+				
+				self.queue.append({"func":func, "args":args, "kwargs":kwargs, "key":None, "queued":True, "timeout":0})
+				self.schedule()
+				return
+			
+			key = (id(args[0]), func.__name__)
+			
+			if key in self.pending:
+				# Superseded, update the pending values
+				self.pending[key]["args"] = args
+				self.pending[key]["kwargs"] = kwargs
+				return
+			
+			entry = self.pending[key] = {"func":func, "args":args, "kwargs":kwargs, "key":key, "queued":False, "timeout":0}
+			
+			delay = self.last_emission.get(key, 0) + rate_limit - time.monotonic()
+			if delay > 0:
+				entry["timeout"] = GLib.timeout_add(int(delay * 1000) + 1, self.on_delay_elapsed, entry)
+			else:
+				self.enqueue(entry)
+	
+	def drain(self):
+		"""
+		Emits a batch of queued signals. Called from the main loop.
+		"""
+		
+		with self.lock:
+			batch = [
+				self.queue.popleft()
+				for x in range(min(self.batch_size, len(self.queue)))
+			]
+			
+			for entry in batch:
+				if entry["key"] is not None:
+					if self.pending.get(entry["key"]) is entry:
+						del self.pending[entry["key"]]
+					self.last_emission[entry["key"]] = time.monotonic()
+		
+		for entry in batch:
+			try:
+				entry["func"](*entry["args"], **entry["kwargs"])
+			except Exception as err:
+				logger.error("Unable to emit %s: %s" % (entry["func"].__name__, err))
+			else:
+				entry["func"].__emitted__.inc()
+		
+		signals_meter.mark(len(batch))
+		
+		with self.lock:
+			if self.queue:
+				# Continue on the next iteration
+				return True
+			
+			self.source = 0
+			return False
+
+dispatcher = SignalDispatcher()
+
 def signal(
-	signature=None
+	signature=None,
+	rate_limit=None # Minimum interval, in seconds, between two emissions. Superseded emissions are merged
 ):
 	
 	"""
 	Handles a DBus signal.
 	If CURRENT_HANDLER != "DBus", the decorated method won't be available.
+	
+	Emissions are dispatched from the main loop by the shared
+	SignalDispatcher.
 	"""
 	
 	def decorator(obj):
@@ -57,6 +217,13 @@ def signal(
 			"org.semplicelinux.channels.%s" % obj.__module__.split(".")[-1], # Get the interface name from the module name
 			signature=signature
 		)(obj)
+		
+		obj.__emitted__ = registry.counter(
+			"channels_signals_emitted_total",
+			"Signals emitted",
+			namespace=obj.__module__.split(".")[-1],
+			signal=obj.__name__
+		)
 
 		def wrapper(*args, **kwargs):
 			"""
@@ -64,7 +231,7 @@ def signal(
 			"""
 			
 			logger.debug("%s: %s, %s" % (obj.__name__, args[1:], kwargs))
-			return GObject.idle_add(obj, *args, **kwargs)
+			dispatcher.emit(obj, args, kwargs, rate_limit)
 
 		# Merge metadata
 		wrapper.__name__ = obj.__name__
@@ -93,17 +260,28 @@ def action(
 	in_signature="", # DBus in_signature
 	out_signature="", # DBus out_signature
 	sender_keyword="sender",
-	connection_keyword="connection"
+	connection_keyword="connection",
+	reply_handler_keyword="reply_handler",
+	error_handler_keyword="error_handler"
 ):
 	
 	"""
 	Modifies the method in order to include settings for
 	the action handler.
+	
+	On DBus, actions that require a polkit privilege are asynchronous:
+	the authorization is checked without blocking the main loop, and
+	the reply is sent when it completes.
+	
+	Actions decorated with channels.common.thread() are executed by the
+	shared job queue (after the authorization, if any). Asynchronous
+	actions decorated with thread(reply_when_done=True) reply when the
+	job completed, others as soon as it has been queued.
 	"""
 	
 	def create_dbus_fixed_method(obj, add_arguments=None):
 		"""
-		When polkit authentication is required, the is_authorized() method
+		When polkit authentication is required, the is_authorized_async() method
 		requires both the sender and the connection objects, which aren't specified
 		in the action.
 		
@@ -160,6 +338,34 @@ def action(
 			# Should hide
 			return None
 		
+		# Metrics
+		labels = dict(namespace=obj.__module__.split(".")[-1], action=obj.__name__)
+		calls = registry.counter("channels_action_calls_total", "Action calls", **labels)
+		failures = registry.counter("channels_action_failures_total", "Action calls that raised an exception", **labels)
+		latency = registry.histogram("channels_action_duration_seconds", "Time spent executing an action", **labels)
+		
+		def run(*args, **kwargs):
+			"""
+			Runs the action, recording its metrics.
+			"""
+			
+			calls.inc()
+			start = time.monotonic()
+			try:
+				return obj(*args, **kwargs)
+			except:
+				failures.inc()
+				raise
+			finally:
+				latency.observe(time.monotonic() - start)
+		
+		# Asynchronous methods get the reply and error handlers
+		async_callbacks = (
+			(reply_handler_keyword, error_handler_keyword)
+			if CURRENT_HANDLER == "DBus" and dbus_visible and polkit_privilege
+			else None
+		)
+		
 		# Wrap around outside_timeout if on DBus
 		if CURRENT_HANDLER == "DBus" and dbus_visible:
 			obj = outside_timeout(
@@ -167,9 +373,69 @@ def action(
 				in_signature=in_signature,
 				out_signature=out_signature,
 				sender_keyword=sender_keyword,
-				connection_keyword=connection_keyword
-			)(create_dbus_fixed_method(obj))
-
+				connection_keyword=connection_keyword,
+				async_callbacks=async_callbacks
+			)(create_dbus_fixed_method(obj, [sender_keyword, connection_keyword] + list(async_callbacks or [])))
+			
+			out_arguments = len(tuple(dbus.Signature(out_signature)))
+		
+		def reply(reply_handler, result):
+			"""
+			Sends the reply of an asynchronous method.
+			"""
+			
+			if out_arguments == 0:
+				reply_handler()
+			elif out_arguments == 1:
+				reply_handler(result)
+			else:
+				reply_handler(*result)
+		
+		def run_and_reply(args, kwargs, reply_handler, error_handler):
+			"""
+			Runs a threaded action, and sends its outcome back from
+			the main loop.
+			"""
+			
+			try:
+				result = run(*args, **kwargs)
+			except Exception as err:
+				GLib.idle_add(error_handler, err)
+				raise
+			
+			GLib.idle_add(reply, reply_handler, result)
+		
+		def execute(args, kwargs, reply_handler=None, error_handler=None):
+			"""
+			Executes the action, or queues it on the job queue if
+			it is threaded.
+			
+			If reply_handler and error_handler are specified, they
+			are used to send the outcome back.
+			"""
+			
+			try:
+				if getattr(wrapper, "__threaded__", False) and getattr(wrapper, "__reply_when_done__", False) and reply_handler is not None:
+					# The reply is sent by run_and_reply()
+					job_queue.submit(run_and_reply, (args, kwargs, reply_handler, error_handler), name=obj.__name__)
+					return None
+				elif getattr(wrapper, "__threaded__", False):
+					job_queue.submit(run, args, kwargs, name=obj.__name__)
+					result = None
+				else:
+					result = run(*args, **kwargs)
+			except Exception as err:
+				if error_handler is None:
+					raise
+				
+				error_handler(err)
+				return None
+			
+			if reply_handler is not None:
+				reply(reply_handler, result)
+			
+			return result
+		
 		def wrapper(*args, **kwargs):
 			"""
 			Method wrapper.
@@ -181,25 +447,44 @@ def action(
 					error("This action is available only for privileged users.")
 			elif CURRENT_HANDLER == "DBus" and polkit_privilege:
 				
-				if sender_keyword in kwargs and connection_keyword in kwargs:
+				if kwargs.get(sender_keyword) and kwargs.get(connection_keyword):
 					# If they are not, the method is called from the inside,
 					# so do not check auth
 					# FIXME: Should investigate more this type of thing
 					# (is it still secure?)
 					
-					if not is_authorized(
+					reply_handler = kwargs.get(reply_handler_keyword)
+					error_handler = kwargs.get(error_handler_keyword)
+					
+					def on_authorization_checked(authorized):
+						"""
+						Fired when the authorization check completed.
+						"""
+						
+						if not authorized:
+							# No way
+							error_handler(Exception("Not authorized"))
+						else:
+							execute(args, kwargs, reply_handler, error_handler)
+					
+					is_authorized_async(
 						# We assume that both the sender and the connection are in kwargs
 						kwargs[sender_keyword],
 						kwargs[connection_keyword],
 						polkit_privilege,
-						True # user interaction
-					):
-						# No way
-						raise Exception("Not authorized")
+						True, # user interaction
+						on_authorization_checked
+					)
+					
+					# The reply will be sent by on_authorization_checked()
+					return None
 				else:
-					# Insert fake sender and connections
+					# Insert fake sender, connection and handlers
 					kwargs[sender_keyword] = None
 					kwargs[connection_keyword] = None
+					if async_callbacks:
+						kwargs[reply_handler_keyword] = None
+						kwargs[error_handler_keyword] = None
 			
 			# Preset with None arguments we should ignore on CLI
 			if CURRENT_HANDLER == "cli":
@@ -208,7 +493,7 @@ def action(
 					if arg in original_list:
 						kwargs[arg] = None
 			
-			result = obj(*args, **kwargs)
+			result = execute(args, kwargs)
 			
 			if CURRENT_HANDLER == "cli" and result != None and not (not command and internal):
 				if cli_output == "print":
@@ -221,12 +506,15 @@ def action(
 			else:
 				return result
 		
+		# Threaded actions are handled by execute()
+		wrapper.__threadable__ = CURRENT_HANDLER == "DBus"
+		
 		# Merge metadata
 		wrapper.__name__ = obj.__name__
 		wrapper.__dict__.update(obj.__dict__)
 
 		# This should work only on CPython
-		wrapper.__actionargs__ = [x for x in obj.__code__.co_varnames[:obj.__code__.co_argcount] if not x in ["self", sender_keyword, connection_keyword] + cli_ignore]
+		wrapper.__actionargs__ = [x for x in obj.__code__.co_varnames[:obj.__code__.co_argcount] if not x in ["self", sender_keyword, connection_keyword, reply_handler_keyword, error_handler_keyword] + cli_ignore]
 
 		wrapper.__grouplast__ = cli_group_last
 		wrapper.__command__ = command
@@ -19,19 +19,105 @@
 #    Eugenio "g7" Paolantonio <me@medesimo.eu>
 #
 
-import dbus.service
-from channels.objects import BaseObject
-
-from threading import Lock
+from types import MappingProxyType
 
+import channels.common
 from channels.common import CURRENT_HANDLER, discovery, actions
 
 import channels.actions
 
+from channels.metrics import TimedLock
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ChannelState:
+	
+	"""
+	An immutable snapshot of the state of every channel, used to answer
+	the read-only Channels actions.
+	
+	A new snapshot is built and published (with a single reference
+	assignment) after every mutation, so readers never block and never
+	see half-applied changes.
+	"""
+	
+	def __init__(self, previous=None, changed=()):
+		"""
+		Builds the snapshot from the discovery cache.
+		
+		If a `previous` snapshot is given, the components are read
+		again only for the `changed` channels and for the channels whose
+		enabled state changed: the others are taken from it.
+		"""
+		
+		# Taken before reading the cache, so that a concurrent refresh
+		# makes the snapshot stale
+		self.generation = channels.common.generation
+		
+		changed = set(changed)
+		
+		enabled = {}
+		components = {}
+		components_enabled = {}
+		
+		for channel, obj in discovery.cache.items():
+			if channel.endswith(".provider"):
+				continue
+			
+			enabled[channel] = obj.enabled
+			
+			if (
+				previous is not None and
+				not channel in changed and
+				previous.enabled.get(channel) == enabled[channel] and
+				channel in previous.components_enabled
+			):
+				components_enabled[channel] = previous.components_enabled[channel]
+				components[channel] = previous.components[channel]
+				continue
+			
+			components_enabled[channel] = MappingProxyType({
+				component:obj.is_component_enabled(component)
+				for component in obj.sections()
+				if not component == "channel"
+			})
+			components[channel] = tuple(sorted(components_enabled[channel]))
+		
+		# Sorted tuple of channels
+		self.channels = (
+			previous.channels
+			if previous is not None and set(previous.channels) == enabled.keys() else
+			tuple(sorted(enabled))
+		)
+		
+		# channel -> enabled
+		self.enabled = MappingProxyType(enabled)
+		
+		# channel -> sorted tuple of components
+		self.components = MappingProxyType(components)
+		
+		# channel -> { component -> enabled }
+		self.components_enabled = MappingProxyType(components_enabled)
+	
+	@property
+	def stale(self):
+		"""
+		True if the discovery cache changed after the snapshot has been
+		built.
+		"""
+		
+		return self.generation != channels.common.generation
+
 class Channels:
 	
 	"""
 	This class manages channels.
+	
+	Mutations are serialized by the lock, and run by the job queue on
+	DBus, off the main loop. Reads are answered from the published
+	ChannelState only.
 	"""
 	
 	def __init__(self):
@@ -39,8 +125,81 @@ class Channels:
 		Initializes the class.
 		"""
 		
-		self.lock = Lock()
+		self.lock = TimedLock("channels")
+		
+		self.state = None
+		
+		# True if a discovery change couldn't be applied to the state,
+		# which must then be built from scratch
+		self.state_outdated = False
+		
+		if CURRENT_HANDLER == "DBus":
+			# Built at startup, so that no read has to wait for it
+			self.publish_state()
+			
+			channels.common.discovery_listeners.append(self.on_discovery_changed)
+	
+	def publish_state(self, changed=None):
+		"""
+		Builds and publishes a new ChannelState.
+		
+		If `changed` is a list of channels, the current state is
+		updated (see ChannelState), rather than built from scratch.
+		
+		Must be called with the lock held (or at startup).
+		"""
+		
+		if self.state_outdated:
+			changed = None
+			self.state_outdated = False
+		
+		self.state = ChannelState(
+			self.state if changed is not None else None,
+			changed or ()
+		)
+	
+	def get_state(self):
+		"""
+		Returns the current ChannelState. Never blocks.
+		
+		On the cli handler, the state is built on the first request.
+		"""
+		
+		state = self.state
+		
+		if state is None:
+			state = self.state = ChannelState()
+		
+		return state
+	
+	def on_discovery_changed(self, changed):
+		"""
+		Fired (with the stages lock held) when the discovery cache
+		changed. Queues the update of the published state.
+		"""
+		
+		def update_state():
+			with self.lock:
+				self.publish_state(changed)
+		
+		try:
+			channels.common.job_queue.submit(update_state, name="channels-state")
+		except channels.common.JobQueueFull:
+			logger.warning("Unable to queue the channel state update, it will be rebuilt by the next change")
+			self.state_outdated = True
+	
+	@channels.actions.signal(
+		signature="as"
+	)
+	def ChannelsChanged(self, changed):
+		"""
+		Signal emitted when channels or providers have been added, removed
+		or changed on disk.
+		"""
+		
+		pass
 
+	@channels.common.thread(reply_when_done=True)
 	@channels.actions.action(
 		root_required=True,
 		polkit_privilege="org.semplicelinux.channels.enable-channel",
@@ -53,12 +212,13 @@ class Channels:
 		Enables a channel.
 		"""
 		
-		self.lock.acquire()
-		result = actions.enable_channel(channel)
-		self.lock.release()
+		with self.lock:
+			result = actions.enable_channel(channel)
+			self.publish_state([channel])
 		
 		return result
 	
+	@channels.common.thread(reply_when_done=True)
 	@channels.actions.action(
 		root_required=True,
 		polkit_privilege="org.semplicelinux.channels.disable-channel",
@@ -71,9 +231,9 @@ class Channels:
 		Disables a channel.
 		"""
 		
-		self.lock.acquire()
-		result = actions.disable_channel(channel)
-		self.lock.release()
+		with self.lock:
+			result = actions.disable_channel(channel)
+			self.publish_state([channel])
 		
 		return result
 	
@@ -88,13 +248,15 @@ class Channels:
 		Lists every available channel.
 		"""
 		
-		return sorted([
-			channel if CURRENT_HANDLER == "DBus" else (
-				"%s%s" % (channel, " (enabled)" if obj.enabled else "")
-			)
-			for channel, obj in discovery.cache.items()
-			if not channel.endswith(".provider")
-		])
+		state = self.get_state()
+		
+		if CURRENT_HANDLER == "DBus":
+			return list(state.channels)
+		
+		return [
+			"%s%s" % (channel, " (enabled)" if state.enabled[channel] else "")
+			for channel in state.channels
+		]
 	
 	@channels.actions.action(
 		command="get-enabled",
@@ -108,8 +270,9 @@ class Channels:
 		Returns True if the given channel is enabled, False otherwise.
 		"""
 		
-		return discovery.cache[channel].enabled if channel in discovery.cache and not channel.endswith(".provider") else False
+		return self.get_state().enabled.get(channel, False)
 	
+	@channels.common.thread(reply_when_done=True)
 	@channels.actions.action(
 		root_required=True,
 		polkit_privilege="org.semplicelinux.channels.enable-component",
@@ -122,12 +285,13 @@ class Channels:
 		Enables a channel component.
 		"""
 		
-		self.lock.acquire()
-		result = actions.enable_component(channel, component)
-		self.lock.release()
+		with self.lock:
+			result = actions.enable_component(channel, component)
+			self.publish_state([channel])
 		
 		return result
 
+	@channels.common.thread(reply_when_done=True)
 	@channels.actions.action(
 		root_required=True,
 		polkit_privilege="org.semplicelinux.channels.disable-component",
@@ -140,12 +304,229 @@ class Channels:
 		Enables a channel component.
 		"""
 		
-		self.lock.acquire()
-		result = actions.disable_component(channel, component)
-		self.lock.release()
+		with self.lock:
+			result = actions.disable_component(channel, component)
+			self.publish_state([channel])
 		
 		return result
 
+	def _parse_changes(self, operations):
+		"""
+		Parses and validates the given operations, and returns a list of
+		(operation, channel, component) tuples.
+		
+		Must be called with the lock held.
+		
+		Every operation is a string in one of these forms:
+		  enable:channel
+		  disable:channel
+		  enable-component:channel:component
+		  disable-component:channel:component
+		
+		Raises an exception if an operation is not valid, if the same
+		target is both enabled and disabled, or if the resulting set
+		of enabled channels has conflicts.
+		"""
+		
+		result = []
+		targets = {}
+		
+		for operation in operations:
+			parts = operation.split(":")
+			
+			if parts[0] in ("enable", "disable") and len(parts) == 2:
+				parts.append(None)
+			elif not (parts[0] in ("enable-component", "disable-component") and len(parts) == 3):
+				raise Exception("Invalid operation: %s" % operation)
+			
+			action, channel, component = parts
+			
+			if not channel in discovery.cache or channel.endswith(".provider"):
+				raise Exception("Unknown channel: %s" % channel)
+			elif component is not None and not discovery.cache[channel].has_component(component):
+				raise Exception("Unknown component of %s: %s" % (channel, component))
+			
+			enable = action.startswith("enable")
+			if targets.get((channel, component), enable) != enable:
+				raise Exception("%s is both enabled and disabled" % (
+					channel if component is None else "%s:%s" % (channel, component)
+				))
+			
+			targets[(channel, component)] = enable
+			result.append((action, channel, component))
+		
+		# Check conflicts against the resulting set of enabled channels
+		enabled = {
+			channel
+			for channel, obj in discovery.cache.items()
+			if not channel.endswith(".provider") and obj.enabled
+		}
+		for (channel, component), enable in targets.items():
+			if component is None:
+				if enable:
+					enabled.add(channel)
+				else:
+					enabled.discard(channel)
+		
+		provided = {
+			channel:set(discovery.cache[channel].get_providers()) | {channel}
+			for channel in enabled
+		}
+		conflicts = {
+			channel:set(discovery.cache[channel].get_conflicts())
+			for channel in enabled
+		}
+		for (channel, component), enable in targets.items():
+			if component is not None or not enable:
+				continue
+			
+			# Both ways: the new channel may conflict with an enabled
+			# one, or an enabled one may conflict with the new channel
+			for other in enabled:
+				if not other == channel and (
+					conflicts[channel] & provided[other] or
+					conflicts[other] & provided[channel]
+				):
+					raise Exception("%s conflicts with %s" % (channel, other))
+		
+		return result
+	
+	def _apply_change(self, action, channel, component):
+		"""
+		Applies a single operation (see _parse_changes()), and returns
+		the result of the libchannels action.
+		"""
+		
+		if action == "enable":
+			return actions.enable_channel(channel)
+		elif action == "disable":
+			return actions.disable_channel(channel)
+		elif action == "enable-component":
+			return actions.enable_component(channel, component)
+		else:
+			return actions.disable_component(channel, component)
+	
+	def _rollback(self, state):
+		"""
+		Restores the enabled channels and components of the given
+		ChannelState, and returns a list of the targets that couldn't
+		be restored.
+		
+		Must be called with the lock held.
+		"""
+		
+		failed = []
+		
+		# Disable first, so that re-enabled channels don't conflict
+		# with the ones enabled by the failed changes
+		to_restore = sorted(
+			(
+				channel
+				for channel, enabled in state.enabled.items()
+				if channel in discovery.cache and discovery.cache[channel].enabled != enabled
+			),
+			key=lambda x: state.enabled[x]
+		)
+		for channel in to_restore:
+			try:
+				if self._apply_change(
+					"enable" if state.enabled[channel] else "disable",
+					channel,
+					None
+				) is False:
+					failed.append(channel)
+			except Exception:
+				failed.append(channel)
+		
+		for channel, components in state.components_enabled.items():
+			if not channel in discovery.cache:
+				continue
+			
+			for component, enabled in components.items():
+				if discovery.cache[channel].is_component_enabled(component) == enabled:
+					continue
+				
+				try:
+					if self._apply_change(
+						"enable-component" if enabled else "disable-component",
+						channel,
+						component
+					) is False:
+						failed.append("%s:%s" % (channel, component))
+				except Exception:
+					failed.append("%s:%s" % (channel, component))
+		
+		return failed
+	
+	@channels.common.thread(reply_when_done=True)
+	@channels.actions.action(
+		root_required=True,
+		polkit_privilege="org.semplicelinux.channels.manage",
+		command="apply",
+		help="Applies several changes at once (enable:CHANNEL, disable:CHANNEL, enable-component:CHANNEL:COMPONENT, disable-component:CHANNEL:COMPONENT)",
+		cli_group_last=True,
+		in_signature="as"
+	)
+	def ApplyChanges(self, operations):
+		"""
+		Applies several enable/disable operations at once.
+		
+		The operations (see _parse_changes()) are validated together
+		before any change is made, and are applied in order with a single
+		authorization check and lock acquisition. Validation, changes and
+		rollback all happen under the lock, so that they see the same
+		channel state.
+		
+		The changes are transactional: if an operation fails (raises or
+		returns False), the previously enabled channels and components
+		are restored and an exception detailing every operation is
+		raised.
+		"""
+		
+		with self.lock:
+			changes = self._parse_changes(operations)
+			
+			# Snapshot of the state to restore: the published one, unless
+			# the discovery cache changed in the meantime
+			previous = self.get_state()
+			if previous.stale:
+				previous = ChannelState()
+			
+			results = []
+			failed = False
+			try:
+				for action, channel, component in changes:
+					try:
+						failed = self._apply_change(action, channel, component) is False
+						results.append("failed" if failed else "ok")
+					except Exception as err:
+						failed = True
+						results.append("failed (%s)" % err)
+					
+					if failed:
+						break
+				
+				if not failed:
+					return
+				
+				not_restored = self._rollback(previous)
+			finally:
+				self.publish_state([channel for action, channel, component in changes])
+		
+		raise Exception(
+			"Unable to apply changes, %s: %s" % (
+				(
+					"rolled back"
+					if not not_restored else
+					"unable to restore %s" % ", ".join(not_restored)
+				),
+				", ".join(
+					"%s %s" % (operation, results[i] if i < len(results) else "skipped")
+					for i, operation in enumerate(operations)
+				)
+			)
+		)
+	
 	@channels.actions.action(
 		command="get-component-enabled",
 		help="Prints \"True\" if the given component of the channel is enabled, \"False\" otherwise",
@@ -158,7 +539,14 @@ class Channels:
 		Returns True if the given component of the channel is enabled, False otherwise.
 		"""
 		
-		return discovery.cache[channel].is_component_enabled(component) if channel in discovery.cache else False
+		if not channel in discovery.cache:
+			return False
+		elif channel.endswith(".provider"):
+			return discovery.cache[channel].is_component_enabled(component)
+		
+		enabled = self.get_state().components_enabled.get(channel, {})
+		
+		return enabled[component] if component in enabled else discovery.cache[channel].is_component_enabled(component)
 	
 	@channels.actions.action(
 		command="has-component",
@@ -186,16 +574,18 @@ class Channels:
 		Lists every component of the given channel.
 		"""
 		
-		if not channel in discovery.cache or channel.endswith(".provider"):
+		state = self.get_state()
+		
+		if not channel in state.components:
 			return []
-
-		return sorted([
-			component if CURRENT_HANDLER == "DBus" else (
-				"%s%s" % (component, " (enabled)" if discovery.cache[channel].is_component_enabled(component) else "")
-			)
-			for component in discovery.cache[channel].sections()
-			if not component == "channel"
-		])
+		
+		if CURRENT_HANDLER == "DBus":
+			return list(state.components[channel])
+		
+		return [
+			"%s%s" % (component, " (enabled)" if state.components_enabled[channel][component] else "")
+			for component in state.components[channel]
+		]
 	
 	@channels.actions.action(
 		command="get-details",
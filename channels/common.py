@@ -31,25 +31,251 @@ import importlib
 
 import threading
 
-import libchannels.discovery
-import libchannels.resolver
-import libchannels.actions
-import libchannels.updates
+import collections
+
+import itertools
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 CURRENT_HANDLER = None
 
+# Number of worker threads used by threaded actions
+JOB_WORKERS = 2
+
+# Maximum number of queued (not yet running) jobs. Further jobs are
+# rejected.
+JOB_QUEUE_LENGTH = 16
+
+# Number of finished jobs kept for inspection
+JOB_HISTORY_LENGTH = 32
+
+class LazyStage:
+	"""
+	A LazyStage is a proxy to a libchannels object that is built only
+	when it's accessed for the first time.
+	
+	This permits commands to pay only for the bootstrap stages they
+	actually use (e.g. "channels show" doesn't need discovery at all).
+	"""
+	
+	# Shared between every stage, as a stage may build its dependencies
+	_lock = threading.RLock()
+	
+	def __init__(self, name, builder):
+		"""
+		Initializes the stage.
+		
+		`name` is the stage name, `builder` is the function that builds
+		and returns the real object.
+		"""
+		
+		object.__setattr__(self, "_name", name)
+		object.__setattr__(self, "_builder", builder)
+		object.__setattr__(self, "_object", None)
+	
+	@property
+	def built(self):
+		"""
+		True if the stage has been already built, False if not.
+		"""
+		
+		return self._object is not None
+	
+	def get(self):
+		"""
+		Returns the real object, building it if required.
+		"""
+		
+		if self._object is None:
+			with self._lock:
+				# Check again, another thread may have built it while
+				# we were waiting
+				if self._object is None:
+					object.__setattr__(self, "_object", self._builder())
+		
+		return self._object
+	
+	def reset(self):
+		"""
+		Drops the real object, so that it will be built again on
+		the next access.
+		"""
+		
+		with self._lock:
+			object.__setattr__(self, "_object", None)
+	
+	def __getattr__(self, name):
+		"""
+		Proxy to the real object.
+		"""
+		
+		return getattr(self.get(), name)
+	
+	def __setattr__(self, name, value):
+		"""
+		Proxy to the real object.
+		"""
+		
+		setattr(self.get(), name, value)
+
+def _build_discovery():
+	"""
+	Builds the discovery stage.
+	
+	On the cli handler, a still valid on-disk snapshot is used instead
+	of discovering channels again (see channels.snapshot).
+	"""
+	
+	import libchannels.discovery
+	
+	if CURRENT_HANDLER == "cli":
+		from channels import snapshot
+		
+		fingerprint = snapshot.fingerprint()
+		result = snapshot.load(fingerprint)
+		if result is not None:
+			return result
+	
+	result = libchannels.discovery.ChannelDiscovery()
+	result.discover()
+	
+	if CURRENT_HANDLER == "cli":
+		snapshot.store(result, fingerprint)
+	
+	return result
+
+def _build_resolver():
+	"""
+	Builds the resolver stage. Requires discovery.
+	"""
+	
+	import libchannels.resolver
+	
+	return libchannels.resolver.DependencyResolver(discovery.get().cache)
+
+def _build_actions():
+	"""
+	Builds the actions stage. Requires discovery and resolver.
+	"""
+	
+	import libchannels.actions
+	
+	return libchannels.actions.Actions(discovery.get(), resolver.get())
+
+def _build_updates():
+	"""
+	Builds the updates stage.
+	"""
+	
+	import libchannels.updates
+	
+	return libchannels.updates.Updates()
+
 # Discovery
-discovery = libchannels.discovery.ChannelDiscovery()
-discovery.discover()
+discovery = LazyStage("discovery", _build_discovery)
 
 # Resolver
-resolver = libchannels.resolver.DependencyResolver(discovery.cache)
+resolver = LazyStage("resolver", _build_resolver)
 
 # Actions
-actions = libchannels.actions.Actions(discovery, resolver)
+actions = LazyStage("actions", _build_actions)
 
 # Updates
-updates = libchannels.updates.Updates()
+updates = LazyStage("updates", _build_updates)
+
+# Every stage, in bootstrap order
+STAGES = (discovery, resolver, actions, updates)
+
+# The discovery generation. It is bumped every time the discovery cache
+# changes, so that anything derived from it can tell if it's stale.
+generation = 0
+
+# Functions called, with the sorted list of changed entries, every time
+# refresh_discovery() changes the discovery cache. They are called with
+# the stages lock held, after the generation has been bumped.
+discovery_listeners = []
+
+def _get_channel_signature(obj):
+	"""
+	Returns a comparable representation of the given channel (or provider)
+	object, used to detect changes between two discoveries.
+	"""
+	
+	return (
+		getattr(obj, "enabled", None),
+		tuple(
+			(section, tuple(sorted(obj[section].items())))
+			for section in obj.sections()
+		),
+		tuple(
+			(section, obj.is_component_enabled(section))
+			for section in obj.sections()
+			if hasattr(obj, "is_component_enabled") and not section == "channel"
+		)
+	)
+
+# Serializes refresh_discovery()
+_refresh_lock = threading.Lock()
+
+def refresh_discovery():
+	"""
+	Discovers channels again, and publishes a new discovery cache with
+	the changed entries.
+	
+	Unchanged entries keep their objects. The new cache is swapped in
+	with a single assignment, so that readers iterating the previous
+	one are not affected. The resolver and actions stages are rebuilt
+	on their next access, and the discovery generation is bumped.
+	
+	The discovery runs without holding the stages lock, but it's still
+	slow: call this from a worker, not from the main loop.
+	
+	Returns a sorted list of the added, removed or changed entries.
+	"""
+	
+	global generation
+	
+	import libchannels.discovery
+	
+	with _refresh_lock:
+		if not discovery.built:
+			# Nothing to refresh, the next access will discover
+			# everything anyway
+			return []
+		
+		fresh = libchannels.discovery.ChannelDiscovery()
+		fresh.discover()
+		
+		with LazyStage._lock:
+			current = discovery.cache
+			cache = {}
+			changed = []
+			
+			for name in set(current) | set(fresh.cache):
+				if not name in fresh.cache:
+					changed.append(name)
+				elif name in current and (
+					_get_channel_signature(current[name]) == _get_channel_signature(fresh.cache[name])
+				):
+					cache[name] = current[name]
+				else:
+					cache[name] = fresh.cache[name]
+					changed.append(name)
+			
+			changed.sort()
+			
+			if changed:
+				discovery.cache = cache
+				resolver.reset()
+				actions.reset()
+				generation += 1
+				
+				for listener in discovery_listeners:
+					listener(changed)
+	
+	return changed
 
 def create_rotated_log(logfile, maximum=5):
 	"""
@@ -77,10 +303,166 @@ def create_rotated_log(logfile, maximum=5):
 	# Finally create the descriptor and return it
 	return os.open(logfile, os.O_RDWR | os.O_CREAT)
 
-def thread():
+class JobQueueFull(Exception):
+	"""
+	Raised when a job is submitted while the job queue is full.
+	"""
+	
+	pass
+
+class Job:
+	"""
+	A job submitted to the JobQueue.
+	"""
+	
+	def __init__(self, id, name, target, args, kwargs):
+		"""
+		Initializes the job.
+		"""
+		
+		self.id = id
+		self.name = name
+		self.target = target
+		self.args = args
+		self.kwargs = kwargs
+		
+		# "queued", "running", "done" or "failed"
+		self.state = "queued"
+
+class JobQueue:
+	"""
+	A bounded pool of worker threads, fed by a visible job queue.
+	
+	Workers are started on demand, up to `workers`. When `max_queued`
+	jobs are already waiting, new jobs are rejected.
+	"""
+	
+	def __init__(self, workers=JOB_WORKERS, max_queued=JOB_QUEUE_LENGTH, history=JOB_HISTORY_LENGTH):
+		"""
+		Initializes the queue.
+		"""
+		
+		self.workers = workers
+		self.max_queued = max_queued
+		
+		self.condition = threading.Condition()
+		
+		self.ids = itertools.count(1)
+		
+		self.queue = collections.deque()
+		self.running = {}
+		self.finished = collections.deque(maxlen=history)
+		
+		self.threads = []
+		self.idle_workers = 0
+	
+	@property
+	def depth(self):
+		"""
+		The number of queued jobs.
+		"""
+		
+		return len(self.queue)
+	
+	@property
+	def busy(self):
+		"""
+		True if there are queued or running jobs, False if not.
+		"""
+		
+		with self.condition:
+			return bool(self.queue or self.running)
+	
+	def get_jobs(self):
+		"""
+		Returns a list of (id, name, state) tuples for every queued,
+		running and recently finished job.
+		"""
+		
+		with self.condition:
+			return [
+				(job.id, job.name, job.state)
+				for job in itertools.chain(self.finished, self.running.values(), self.queue)
+			]
+	
+	def submit(self, target, args=(), kwargs=None, name=None):
+		"""
+		Queues the given target, and returns its Job.
+		
+		Raises JobQueueFull if the queue is full.
+		"""
+		
+		if kwargs is None:
+			kwargs = {}
+		
+		with self.condition:
+			if len(self.queue) >= self.max_queued:
+				raise JobQueueFull("Too many queued jobs, try again later")
+			
+			job = Job(
+				next(self.ids),
+				name or target.__name__,
+				target,
+				args,
+				kwargs
+			)
+			self.queue.append(job)
+			
+			logger.debug("Job %d (%s) queued, depth %d" % (job.id, job.name, len(self.queue)))
+			
+			if not self.idle_workers and len(self.threads) < self.workers:
+				worker = threading.Thread(target=self.work, daemon=True)
+				self.threads.append(worker)
+				worker.start()
+			else:
+				self.condition.notify()
+		
+		return job
+	
+	def work(self):
+		"""
+		The worker thread loop.
+		"""
+		
+		while True:
+			with self.condition:
+				while not self.queue:
+					self.idle_workers += 1
+					self.condition.wait()
+					self.idle_workers -= 1
+				
+				job = self.queue.popleft()
+				job.state = "running"
+				self.running[job.id] = job
+			
+			try:
+				job.target(*job.args, **job.kwargs)
+			except Exception as err:
+				logger.error("Job %d (%s) failed: %s" % (job.id, job.name, err))
+				job.state = "failed"
+			else:
+				job.state = "done"
+			
+			with self.condition:
+				del self.running[job.id]
+				
+				# Drop references to the arguments
+				job.target = job.args = job.kwargs = None
+				self.finished.append(job)
+
+job_queue = JobQueue()
+
+def thread(reply_when_done=False):
 	
 	"""
 	Function decorator that ease the creation of threaded methods.
+	
+	Calls are queued on the shared job_queue, and executed by its
+	bounded pool of workers.
+	
+	If `reply_when_done` is True, asynchronous DBus actions send their
+	reply (the result, or the error) once the job completed, rather
+	than as soon as it has been queued.
 	"""
 	
 	def decorator(obj):
@@ -91,12 +473,18 @@ def thread():
 		if not obj:
 			return None
 		
+		if getattr(obj, "__threadable__", False):
+			# Actions queue themselves, once they have been authorized
+			obj.__threaded__ = True
+			obj.__reply_when_done__ = reply_when_done
+			return obj
+		
 		def wrapper(*args, **kwargs):
 			"""
 			The function wrapper.
 			"""
 			
-			threading.Thread(target=obj, args=args, kwargs=kwargs).start()
+			job_queue.submit(obj, args, kwargs)
 		
 		# Merge metadata
 		wrapper.__name__ = obj.__name__
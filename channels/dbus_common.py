@@ -23,12 +23,17 @@ import dbus
 
 import threading
 
+import time
+
 import logging
 
 from gi.repository import GLib, Polkit
 
 from dbus.mainloop.glib import DBusGMainLoop
 
+from channels.common import job_queue
+from channels.metrics import registry
+
 authority = Polkit.Authority.get_sync()
 
 logger = logging.getLogger(__name__)
@@ -36,6 +41,80 @@ logger = logging.getLogger(__name__)
 DBusGMainLoop(set_as_default=True)
 BUS = dbus.SystemBus()
 
+# Seconds after which a cached authorization expires
+AUTHORIZATION_CACHE_TTL = 60
+
+class AuthorizationCache():
+	"""
+	Caches successful polkit authorizations, per sender and privilege.
+	
+	Entries expire after `ttl` seconds, and are dropped when the sender
+	disconnects from the bus. Failed authorizations are never cached,
+	so that users can try again.
+	
+	Only authorizations granted without user interaction, or that
+	polkit itself allows to keep (auth_admin_keep and friends), should
+	be stored: an interactive auth_admin grant is valid for a single
+	call.
+	"""
+	
+	def __init__(self, ttl=AUTHORIZATION_CACHE_TTL):
+		"""
+		Initializes the cache.
+		"""
+		
+		self.ttl = ttl
+		
+		self.lock = threading.Lock()
+		
+		# sender -> { privilege -> expiration time }
+		self.entries = {}
+		
+		self.hits = 0
+		self.misses = 0
+	
+	def lookup(self, sender, privilege):
+		"""
+		Returns True if the sender has been recently authorized for the
+		given privilege, False if not.
+		
+		Hits and misses are not counted when the cache is disabled.
+		"""
+		
+		if self.ttl <= 0:
+			return False
+		
+		with self.lock:
+			expiration = self.entries.get(sender, {}).get(privilege)
+			
+			if expiration is not None and expiration > time.monotonic():
+				self.hits += 1
+				return True
+			
+			self.misses += 1
+			return False
+	
+	def store(self, sender, privilege):
+		"""
+		Stores a successful authorization.
+		"""
+		
+		if self.ttl <= 0:
+			return
+		
+		with self.lock:
+			self.entries.setdefault(sender, {})[privilege] = time.monotonic() + self.ttl
+	
+	def forget(self, sender):
+		"""
+		Drops every authorization of the given sender.
+		"""
+		
+		with self.lock:
+			self.entries.pop(sender, None)
+
+authorization_cache = AuthorizationCache()
+
 class LoopWithTimeout():
 	"""
 	A LoopWithTimeout is a GLibMainLoop that supports timeouts.
@@ -50,66 +129,68 @@ class LoopWithTimeout():
 		
 		self.loop = GLib.MainLoop()
 		
-		self.connected_clients = []
+		self.connected_clients = set()
+		
+		# Functions called with the unique name of every client that
+		# disconnects, to free the per-client bookkeeping
+		self.disconnect_callbacks = []
 		
 		self.timeout = 0
 		self.timeout_length = timeout_length
 		
+		# A single, bus-wide subscription
+		BUS.add_signal_receiver(
+			handler_function=self.on_name_owner_changed,
+			signal_name="NameOwnerChanged",
+			dbus_interface="org.freedesktop.DBus",
+			path="/org/freedesktop/DBus"
+		)
+		
 		self.add_timeout()
 	
+	@property
+	def client_count(self):
+		"""
+		The number of connected clients.
+		"""
+		
+		return len(self.connected_clients)
+	
 	def add_client(self, client):
 		"""
 		Adds a client to the connected_clients.
 		"""
 		
 		logger.debug("Client %s connected" % client)
-		self.connected_clients.append(client)
-		
-		# Subscribe to changes
-		BUS.add_signal_receiver(
-			handler_function=self.on_name_owner_changed,
-			signal_name="NameOwnerChanged",
-			dbus_interface="org.freedesktop.DBus",
-			path="/org/freedesktop/DBus",
-			arg0=client
-		)
+		self.connected_clients.add(client)
 
 	def on_name_owner_changed(self, name, old_owner, new_owner):
 		"""
 		A callback for NameOwnerChanged that can be hooked on the bus.
 		
 		This callback is reponsible to update the self.connected_clients
-		list so that the MainLoop stays aware of the connected clients.
-		
-		Note that this method doesn't do any filtering.
+		set so that the MainLoop stays aware of the connected clients.
 		"""
 		
-		if not name.startswith(":") or new_owner:
-			# Us or new_owner (wtf), discard
+		if new_owner or not name in self.connected_clients:
+			# Not a disconnection of one of our clients, discard
 			return
 		
-		if name in self.connected_clients:
-			# Client disconnection
-			logger.debug("Client %s disconnected" % name)
-			self.connected_clients.remove(name)
-			
-			# Unsubscribe to changes
-			BUS.remove_signal_receiver(
-				handler_or_match=self.on_name_owner_changed,
-				signal_name="NameOwnerChanged",
-				dbus_interface="org.freedesktop.DBus",
-				path="/org/freedesktop/DBus",
-				arg0=old_owner
-			)
+		# Client disconnection
+		logger.debug("Client %s disconnected" % name)
+		self.connected_clients.discard(name)
+		
+		for callback in self.disconnect_callbacks:
+			callback(name)
 
 	def on_timeout_elapsed(self):
 		"""
 		Fired when the timeout elapsed.
 		"""
 		
-		if len(threading.enumerate()) > 1 or self.connected_clients:
-			# Threads still running or there still are connected clients,
-			# delay the timeout
+		if job_queue.busy or self.connected_clients:
+			# Jobs still queued or running or there still are connected
+			# clients, delay the timeout
 			return True
 		
 		self.quit()
@@ -141,24 +222,217 @@ class LoopWithTimeout():
 		
 		return getattr(self.loop, name)
 
-def get_user(sender):
+class CredentialsCache():
 	"""
-	Returns the user name of the given sender.
+	Caches the credentials of the connected senders.
+	
+	Credentials are looked up once per unique sender name (which is
+	never reused on the bus), and dropped when the sender disconnects.
+	Lookups that complete after the sender disconnected are not stored.
 	"""
 	
-	return dbus.Interface(
-		dbus.SystemBus().get_object(
-			"org.freedesktop.DBus",
-			"/org/freedesktop/DBus"
-		),
-		"org.freedesktop.DBus"
-	).GetConnectionUnixUser(sender)
+	def __init__(self):
+		"""
+		Initializes the cache.
+		"""
+		
+		self.lock = threading.Lock()
+		
+		# sender -> credentials dictionary
+		self.entries = {}
+		
+		# sender -> number of lookups in progress
+		self.pending = {}
+		
+		self._bus_interface = None
+	
+	@property
+	def bus_interface(self):
+		"""
+		The org.freedesktop.DBus interface of the bus daemon.
+		"""
+		
+		if self._bus_interface is None:
+			self._bus_interface = dbus.Interface(
+				BUS.get_object(
+					"org.freedesktop.DBus",
+					"/org/freedesktop/DBus"
+				),
+				"org.freedesktop.DBus"
+			)
+		
+		return self._bus_interface
+	
+	def _convert(self, credentials):
+		"""
+		Returns a dictionary with the "UnixUserID" and "ProcessID" keys
+		of the given bus credentials.
+		"""
+		
+		return {
+			"UnixUserID" : int(credentials["UnixUserID"]),
+			"ProcessID" : int(credentials["ProcessID"])
+		}
+	
+	def lookup(self, sender):
+		"""
+		Asks the bus for the credentials of the given sender.
+		
+		Returns a dictionary with (at least) the "UnixUserID" and
+		"ProcessID" keys.
+		"""
+		
+		try:
+			credentials = self.bus_interface.GetConnectionCredentials(sender)
+		except dbus.exceptions.DBusException as err:
+			if not err.get_dbus_name() == "org.freedesktop.DBus.Error.UnknownMethod":
+				raise
+			
+			# Older bus daemon
+			credentials = {
+				"UnixUserID" : self.bus_interface.GetConnectionUnixUser(sender),
+				"ProcessID" : self.bus_interface.GetConnectionUnixProcessID(sender)
+			}
+		
+		return self._convert(credentials)
+	
+	def lookup_async(self, sender, callback, error_callback):
+		"""
+		Like lookup(), but without blocking: `callback` is called with
+		the credentials, `error_callback` with the exception.
+		"""
+		
+		def on_error(err):
+			"""
+			Fired when GetConnectionCredentials failed.
+			"""
+			
+			if not (
+				isinstance(err, dbus.exceptions.DBusException) and
+				err.get_dbus_name() == "org.freedesktop.DBus.Error.UnknownMethod"
+			):
+				error_callback(err)
+				return
+			
+			# Older bus daemon
+			def on_user(uid):
+				self.bus_interface.GetConnectionUnixProcessID(
+					sender,
+					reply_handler=lambda pid: callback(
+						self._convert({"UnixUserID" : uid, "ProcessID" : pid})
+					),
+					error_handler=error_callback
+				)
+			
+			self.bus_interface.GetConnectionUnixUser(
+				sender,
+				reply_handler=on_user,
+				error_handler=error_callback
+			)
+		
+		self.bus_interface.GetConnectionCredentials(
+			sender,
+			reply_handler=lambda credentials: callback(self._convert(credentials)),
+			error_handler=on_error
+		)
+	
+	def _begin(self, sender):
+		"""
+		Records the start of a lookup. Returns the cached credentials,
+		or None if the lookup should go on.
+		"""
+		
+		with self.lock:
+			if sender in self.entries:
+				return self.entries[sender]
+			
+			self.pending[sender] = self.pending.get(sender, 0) + 1
+			return None
+	
+	def _end(self, sender, credentials=None):
+		"""
+		Records the end of a lookup, storing the credentials only if
+		the sender didn't disconnect in the meantime.
+		"""
+		
+		with self.lock:
+			if not sender in self.pending:
+				# Forgotten
+				return
+			
+			if credentials is not None:
+				self.entries[sender] = credentials
+			
+			self.pending[sender] -= 1
+			if not self.pending[sender]:
+				del self.pending[sender]
+	
+	def get(self, sender):
+		"""
+		Returns the credentials of the given sender.
+		
+		Blocks while the bus is asked: on the main loop, use
+		get_async() instead.
+		"""
+		
+		credentials = self._begin(sender)
+		if credentials is not None:
+			return credentials
+		
+		try:
+			credentials = self.lookup(sender)
+		finally:
+			self._end(sender, credentials)
+		
+		return credentials
+	
+	def get_async(self, sender, callback, error_callback):
+		"""
+		Calls `callback` with the credentials of the given sender, or
+		`error_callback` with the exception, without blocking.
+		"""
+		
+		credentials = self._begin(sender)
+		if credentials is not None:
+			callback(credentials)
+			return
+		
+		def on_credentials(credentials):
+			self._end(sender, credentials)
+			callback(credentials)
+		
+		def on_error(err):
+			self._end(sender)
+			error_callback(err)
+		
+		try:
+			self.lookup_async(sender, on_credentials, on_error)
+		except Exception as err:
+			on_error(err)
+	
+	def forget(self, sender):
+		"""
+		Drops the credentials of the given sender.
+		"""
+		
+		with self.lock:
+			self.entries.pop(sender, None)
+			self.pending.pop(sender, None)
 
-def is_authorized(sender, connection, privilege, user_interaction=True):
+credentials_cache = CredentialsCache()
+
+def get_user(sender):
+	"""
+	Returns the UID of the given sender.
 	"""
-	Checks if the sender has the given privilege.
 	
-	Returns True if yes, False if not.
+	return credentials_cache.get(sender)["UnixUserID"]
+
+def get_subject(credentials, user_interaction=True):
+	"""
+	Returns a tuple containing the polkit subject of the sender with
+	the given credentials (see CredentialsCache) and the flags to use
+	in the authorization check.
 	"""
 	
 	if not user_interaction:
@@ -166,26 +440,135 @@ def is_authorized(sender, connection, privilege, user_interaction=True):
 	else:
 		flags = Polkit.CheckAuthorizationFlags.ALLOW_USER_INTERACTION
 	
-	# Get PID
-	pid = dbus.Interface(
-		BUS.get_object(
-			"org.freedesktop.DBus",
-			"/org/freedesktop/DBus"
+	return (
+		Polkit.UnixProcess.new_for_owner(
+			credentials["ProcessID"],
+			0, # Let polkit look up the start time
+			credentials["UnixUserID"]
 		),
-		"org.freedesktop.DBus"
-	).GetConnectionUnixProcessID(sender)
+		flags
+	)
+
+def get_polkit_latency(privilege):
+	"""
+	Returns the histogram of the polkit check latency for the given
+	privilege.
+	
+	Note: with user interaction, it includes the time the user took to
+	authenticate.
+	"""
+	
+	return registry.histogram(
+		"channels_polkit_check_seconds",
+		"Time spent waiting for polkit authorization checks",
+		privilege=privilege
+	)
+
+def is_authorized_async(sender, connection, privilege, user_interaction, callback):
+	"""
+	Checks if the sender has the given privilege, without blocking
+	the main loop (the credentials of the sender are looked up
+	asynchronously too).
+	
+	`callback` is called with True if the sender is authorized, False
+	if not.
+	
+	The sender is first checked without user interaction: if polkit
+	asks for authentication, the check is repeated allowing it (when
+	`user_interaction` is True).
+	Authorizations granted without interaction, or retained by polkit,
+	are cached (see AuthorizationCache).
+	"""
+	
+	if authorization_cache.lookup(sender, privilege):
+		callback(True)
+		return
+	
+	# Set once the credentials of the sender are known
+	subject = flags = None
+	
+	def check(check_flags, on_result):
+		"""
+		Asks polkit, and calls `on_result` with the AuthorizationResult
+		(None on failure).
+		"""
+		
+		start = time.monotonic()
 		
-	try:
-		result = authority.check_authorization_sync(
-			Polkit.UnixProcess.new(pid),
+		def on_checked(authority, result):
+			"""
+			Fired when polkit answered.
+			"""
+			
+			get_polkit_latency(privilege).observe(time.monotonic() - start)
+			
+			try:
+				result = authority.check_authorization_finish(result)
+			except Exception as err:
+				logger.warning("Unable to check authorization of %s for %s: %s" % (sender, privilege, err))
+				result = None
+			
+			on_result(result)
+		
+		authority.check_authorization(
+			subject,
 			privilege,
 			None,
-			flags,
-			None
+			check_flags,
+			None,
+			on_checked
 		)
-	except:
-		return False
 	
-	return result.get_is_authorized()
+	def on_interactive_result(result):
+		"""
+		Fired when polkit answered the check with user interaction.
+		"""
+		
+		authorized = result is not None and result.get_is_authorized()
+		
+		# A one-shot auth_admin grant must not outlive this call
+		if authorized and result.get_retains_authorization():
+			authorization_cache.store(sender, privilege)
+		
+		callback(authorized)
+	
+	def on_result(result):
+		"""
+		Fired when polkit answered the check without user interaction.
+		"""
+		
+		if result is not None and result.get_is_authorized():
+			authorization_cache.store(sender, privilege)
+			callback(True)
+		elif (
+			result is not None and result.get_is_challenge() and
+			flags == Polkit.CheckAuthorizationFlags.ALLOW_USER_INTERACTION
+		):
+			check(flags, on_interactive_result)
+		else:
+			callback(False)
+	
+	def on_credentials(credentials):
+		"""
+		Fired when the credentials of the sender are known.
+		"""
+		
+		nonlocal subject, flags
+		
+		subject, flags = get_subject(credentials, user_interaction)
+		
+		check(Polkit.CheckAuthorizationFlags.NONE, on_result)
+	
+	def on_credentials_error(err):
+		"""
+		Fired when the credentials of the sender couldn't be looked up.
+		"""
+		
+		logger.warning("Unable to get credentials of %s: %s" % (sender, err))
+		callback(False)
+	
+	credentials_cache.get_async(sender, on_credentials, on_credentials_error)
 
 MainLoop = LoopWithTimeout(5 * 60)
+MainLoop.disconnect_callbacks.append(authorization_cache.forget)
+MainLoop.disconnect_callbacks.append(credentials_cache.forget)
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import time
+
+import bisect
+
+import tempfile
+
+import threading
+
+import contextlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (
+	0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+	1, 2.5, 5, 10, 30, 60, 300, 900, 1800
+)
+
+# Window, in seconds, of the per-second rates
+METER_WINDOW = 10
+
+# Note: metrics are updated without locking, to keep the cost on the
+# hot paths down to a few attribute updates. An increment lost to a
+# race between threads is acceptable for monitoring purposes.
+
+class Counter:
+	"""
+	A monotonically increasing counter.
+	"""
+	
+	type = "counter"
+	
+	def __init__(self):
+		"""
+		Initializes the class.
+		"""
+		
+		self.value = 0
+	
+	def inc(self, amount=1):
+		"""
+		Increments the counter.
+		"""
+		
+		self.value += amount
+	
+	def get_samples(self):
+		"""
+		Returns a list of (suffix, extra labels, value) samples.
+		"""
+		
+		return [("", (), self.value)]
+
+class Gauge:
+	"""
+	A value that can go up and down, read from a function.
+	"""
+	
+	type = "gauge"
+	
+	def __init__(self, func):
+		"""
+		Initializes the class.
+		"""
+		
+		self.func = func
+	
+	def get_samples(self):
+		"""
+		Returns a list of (suffix, extra labels, value) samples.
+		"""
+		
+		return [("", (), self.func())]
+
+class Meter:
+	"""
+	Counts events, and gives the number of events per second over the
+	last METER_WINDOW seconds.
+	"""
+	
+	type = "gauge"
+	
+	def __init__(self, window=METER_WINDOW):
+		"""
+		Initializes the class.
+		"""
+		
+		self.window = window
+		
+		# One slot per second
+		self.slots = [0] * window
+		self.second = int(time.monotonic())
+	
+	def _rotate(self, now):
+		"""
+		Clears the slots of the seconds elapsed since the last event.
+		"""
+		
+		elapsed = now - self.second
+		if elapsed > 0:
+			for i in range(1, min(elapsed, self.window) + 1):
+				self.slots[(self.second + i) % self.window] = 0
+			self.second = now
+	
+	def mark(self, amount=1):
+		"""
+		Records the given number of events.
+		"""
+		
+		now = int(time.monotonic())
+		if now != self.second:
+			self._rotate(now)
+		
+		self.slots[now % self.window] += amount
+	
+	@property
+	def rate(self):
+		"""
+		Returns the number of events per second.
+		"""
+		
+		self._rotate(int(time.monotonic()))
+		
+		return sum(self.slots) / self.window
+	
+	def get_samples(self):
+		"""
+		Returns a list of (suffix, extra labels, value) samples.
+		"""
+		
+		return [("", (), self.rate)]
+
+class Histogram:
+	"""
+	Counts observations (typically durations) in buckets.
+	"""
+	
+	type = "histogram"
+	
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		"""
+		Initializes the class.
+		"""
+		
+		self.buckets = tuple(buckets)
+		
+		# The last slot counts the observations above the last bucket
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+	
+	def observe(self, value):
+		"""
+		Records an observation.
+		"""
+		
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+	
+	@contextlib.contextmanager
+	def time(self):
+		"""
+		Context manager that observes the time spent in its block.
+		"""
+		
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(time.monotonic() - start)
+	
+	def get_samples(self):
+		"""
+		Returns a list of (suffix, extra labels, value) samples, with
+		cumulative buckets.
+		"""
+		
+		samples = []
+		
+		cumulative = 0
+		for bucket, count in zip(self.buckets + (float("inf"),), self.counts):
+			cumulative += count
+			samples.append(
+				("_bucket", (("le", "+Inf" if bucket == float("inf") else repr(bucket)),), cumulative)
+			)
+		
+		samples.append(("_sum", (), self.sum))
+		samples.append(("_count", (), self.count))
+		
+		return samples
+
+class TimedLock:
+	"""
+	A drop-in replacement for threading.Lock that records the time
+	spent waiting for it.
+	"""
+	
+	def __init__(self, name, metrics_registry=None):
+		"""
+		Initializes the class.
+		"""
+		
+		self._lock = threading.Lock()
+		self._wait = (metrics_registry or registry).histogram(
+			"channels_lock_wait_seconds",
+			"Time spent waiting for a lock",
+			lock=name
+		)
+	
+	def acquire(self, blocking=True, timeout=-1):
+		"""
+		Acquires the lock.
+		"""
+		
+		# Fast path, no wait
+		if self._lock.acquire(False):
+			self._wait.observe(0)
+			return True
+		elif not blocking:
+			return False
+		
+		start = time.monotonic()
+		result = self._lock.acquire(True, timeout)
+		if result:
+			self._wait.observe(time.monotonic() - start)
+		
+		return result
+	
+	def release(self):
+		"""
+		Releases the lock.
+		"""
+		
+		self._lock.release()
+	
+	def locked(self):
+		"""
+		Returns True if the lock is held.
+		"""
+		
+		return self._lock.locked()
+	
+	def __enter__(self):
+		"""
+		Acquires the lock.
+		"""
+		
+		self.acquire()
+		return self
+	
+	def __exit__(self, *args):
+		"""
+		Releases the lock.
+		"""
+		
+		self.release()
+
+class Registry:
+	"""
+	Keeps the metrics of the service.
+	
+	Metrics are identified by a name and a set of labels, and are
+	created on first use: callers on hot paths should keep a reference
+	to them rather than looking them up every time.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the class.
+		"""
+		
+		self.lock = threading.Lock()
+		
+		# name -> (type, help)
+		self.families = {}
+		
+		# (name, labels) -> metric
+		self.metrics = {}
+	
+	def _get(self, name, help, labels, factory):
+		"""
+		Returns the metric with the given name and labels, creating it
+		with `factory` if missing.
+		"""
+		
+		key = (name, tuple(sorted(labels.items())))
+		
+		metric = self.metrics.get(key)
+		if metric is not None:
+			return metric
+		
+		with self.lock:
+			if not key in self.metrics:
+				metric = factory()
+				self.families.setdefault(name, (metric.type, help))
+				self.metrics[key] = metric
+			
+			return self.metrics[key]
+	
+	def counter(self, name, help, **labels):
+		"""
+		Returns the given Counter.
+		"""
+		
+		return self._get(name, help, labels, Counter)
+	
+	def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+		"""
+		Returns the given Histogram.
+		"""
+		
+		return self._get(name, help, labels, lambda: Histogram(buckets))
+	
+	def meter(self, name, help, **labels):
+		"""
+		Returns the given Meter.
+		"""
+		
+		return self._get(name, help, labels, Meter)
+	
+	def gauge(self, name, help, func, **labels):
+		"""
+		Registers a Gauge that reads its value from `func`.
+		"""
+		
+		return self._get(name, help, labels, lambda: Gauge(func))
+	
+	def get_samples(self):
+		"""
+		Returns a list of (name, labels, value) samples, where labels
+		is a tuple of (label, value) tuples, sorted by metric.
+		"""
+		
+		with self.lock:
+			metrics = sorted(self.metrics.items(), key=lambda x: x[0])
+		
+		samples = []
+		for (name, labels), metric in metrics:
+			try:
+				for suffix, extra, value in metric.get_samples():
+					samples.append((name + suffix, labels + extra, value))
+			except Exception as err:
+				logger.warning("Unable to read metric %s: %s" % (name, err))
+		
+		return samples
+	
+	def get_metrics(self):
+		"""
+		Returns a dictionary that maps every sample, formatted as
+		name{label="value",...}, to its value.
+		"""
+		
+		return {
+			_format_sample(name, labels) : float(value)
+			for name, labels, value in self.get_samples()
+		}
+	
+	def to_text(self):
+		"""
+		Returns the metrics in the Prometheus text exposition format.
+		"""
+		
+		samples = self.get_samples()
+		
+		lines = []
+		family = None
+		for name, labels, value in samples:
+			base = name
+			for suffix in ("_bucket", "_sum", "_count"):
+				if name.endswith(suffix) and name[:-len(suffix)] in self.families:
+					base = name[:-len(suffix)]
+			
+			if base != family and base in self.families:
+				family = base
+				type_, help = self.families[base]
+				lines.append("# HELP %s %s" % (base, help))
+				lines.append("# TYPE %s %s" % (base, type_))
+			
+			lines.append("%s %s" % (_format_sample(name, labels), repr(float(value))))
+		
+		return "\n".join(lines) + "\n"
+	
+	def write_textfile(self, path):
+		"""
+		Writes the metrics to the given file, atomically, so that the
+		node_exporter textfile collector never reads a partial file.
+		"""
+		
+		directory = os.path.dirname(path)
+		
+		fd, temp = tempfile.mkstemp(dir=directory, prefix=".channels.", suffix=".prom.tmp")
+		try:
+			with os.fdopen(fd, "w") as f:
+				f.write(self.to_text())
+			os.chmod(temp, 0o644)
+			os.replace(temp, path)
+		except:
+			os.remove(temp)
+			raise
+
+def _format_sample(name, labels):
+	"""
+	Formats the given sample name and labels.
+	"""
+	
+	if not labels:
+		return name
+	
+	return "%s{%s}" % (
+		name,
+		",".join(
+			"%s=\"%s\"" % (
+				label,
+				str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+			)
+			for label, value in labels
+		)
+	)
+
+registry = Registry()
@@ -19,10 +19,13 @@
 #    Eugenio "g7" Paolantonio <me@medesimo.eu>
 #
 
-from channels.dbus_common import MainLoop, is_authorized, get_user
+from channels.dbus_common import MainLoop, is_authorized_async, credentials_cache
 
 import dbus
 import dbus.service
+import dbus.exceptions
+
+import time
 
 from gi.repository import GLib, Polkit
 
@@ -59,6 +62,27 @@ class BaseObject(dbus.service.Object):
 	# The list of UIDs that can set properties without authentication.
 	# NOTE: Please populate it from the __init__ method of your object!
 	set_privileges = []
+	
+	# Seconds between two periodic checks of the exported properties,
+	# while should_tick_properties() returns True. This catches changes
+	# of computed properties (0 disables).
+	properties_tick_interval = 0
+	
+	# The last published values of the exported properties (None
+	# until the object has been initialized)
+	_published_properties = None
+	
+	_properties_source = 0
+	_properties_tick_source = 0
+	
+	# Exported properties (by their DBus name) whose value can be
+	# cached, with the number of seconds the cached value is valid.
+	# Useful for expensive computed properties.
+	cached_properties = {}
+	
+	# DBus property name -> attribute name, built on __init__
+	_property_registry = {}
+	_exported_attributes = frozenset()
 
 	def outside_timeout(*args, **kwargs):
 		"""
@@ -106,6 +130,155 @@ class BaseObject(dbus.service.Object):
 		"""
 		
 		super().__init__(bus_name, self.path)
+		
+		self._property_registry = {
+			prop[0].upper() + prop[1:]:prop
+			for prop in self.export_properties
+		}
+		self._exported_attributes = frozenset(self.export_properties)
+		self._property_cache = {}
+		
+		self._published_properties = self.get_properties()
+	
+	def __setattr__(self, name, value):
+		"""
+		Schedules a PropertiesChanged check when an exported property
+		is changed.
+		"""
+		
+		super().__setattr__(name, value)
+		
+		if name in self._exported_attributes:
+			self.schedule_properties_changed()
+	
+	def get_property(self, name):
+		"""
+		Returns the current value of the given exported property (by
+		its DBus name).
+		
+		Raises KeyError if the property is not exported.
+		"""
+		
+		attribute = self._property_registry[name]
+		
+		if not name in self.cached_properties:
+			return getattr(self, attribute)
+		
+		now = time.monotonic()
+		
+		cached = self._property_cache.get(name)
+		if cached is not None and cached[0] > now:
+			return cached[1]
+		
+		value = getattr(self, attribute)
+		self._property_cache[name] = (now + self.cached_properties[name], value)
+		
+		return value
+	
+	def get_properties(self):
+		"""
+		Returns a dictionary with the current values of the exported
+		properties.
+		
+		Properties whose getter fails are skipped.
+		"""
+		
+		result = {}
+		
+		for name in self._property_registry:
+			try:
+				result[name] = self.get_property(name)
+			except:
+				pass
+		
+		return result
+	
+	def should_tick_properties(self):
+		"""
+		Override this method to return True when computed properties
+		may change, and should be checked periodically.
+		"""
+		
+		return False
+	
+	def schedule_properties_changed(self):
+		"""
+		Schedules a PropertiesChanged check on the main loop.
+		
+		Multiple requests made in the same main loop iteration are
+		coalesced. This can be called from any thread.
+		"""
+		
+		if self._published_properties is None:
+			# Not yet initialized
+			return
+		
+		if not self._properties_source:
+			self._properties_source = GLib.idle_add(self.on_properties_check)
+	
+	def on_properties_check(self):
+		"""
+		Compares the exported properties with the last published values,
+		and emits PropertiesChanged with the changed ones.
+		"""
+		
+		self._properties_source = 0
+		
+		current = self.get_properties()
+		changed = {
+			name:value
+			for name, value in current.items()
+			if not name in self._published_properties or self._published_properties[name] != value
+		}
+		invalidated = [
+			name
+			for name in self._published_properties
+			if not name in current
+		]
+		
+		self._published_properties = current
+		
+		if changed or invalidated:
+			self.PropertiesChanged(self.interface_name, changed, invalidated)
+		
+		# Start ticking, if required
+		if (
+			self.properties_tick_interval > 0 and
+			not self._properties_tick_source and
+			self.should_tick_properties()
+		):
+			self._properties_tick_source = GLib.timeout_add(
+				int(self.properties_tick_interval * 1000),
+				self.on_properties_tick
+			)
+		
+		return False
+	
+	def on_properties_tick(self):
+		"""
+		Fired periodically while should_tick_properties() returns True.
+		"""
+		
+		if not self.should_tick_properties():
+			self._properties_tick_source = 0
+			self.schedule_properties_changed()
+			return False
+		
+		self.on_properties_check()
+		
+		return True
+	
+	@dbus.service.signal(
+		dbus_interface=dbus.PROPERTIES_IFACE,
+		signature="sa{sv}as"
+	)
+	def PropertiesChanged(self, interface_name, changed_properties, invalidated_properties):
+		"""
+		An implementation of the PropertiesChanged() signal of the
+		properties interface.
+		"""
+		
+		pass
 	
 	def store_property(self, name, value):
 		"""
@@ -124,9 +297,22 @@ class BaseObject(dbus.service.Object):
 		"""
 		An implementation of the Get() method of the
 		properties interface.
+		
+		Only the requested property is evaluated.
 		"""
 		
-		return self.GetAll(interface_name)[property_name]
+		if not interface_name == self.interface_name:
+			raise dbus.exceptions.DBusException(
+				"The object does not implement the %s interface" % interface_name,
+				name="org.freedesktop.DBus.Error.UnknownInterface"
+			)
+		elif not property_name in self._property_registry:
+			raise dbus.exceptions.DBusException(
+				"The object does not have the %s property" % property_name,
+				name="org.freedesktop.DBus.Error.UnknownProperty"
+			)
+		
+		return self.get_property(property_name)
 	
 	@outside_timeout(
 		dbus_interface=dbus.PROPERTIES_IFACE,
@@ -140,39 +326,61 @@ class BaseObject(dbus.service.Object):
 		"""
 		
 		if interface_name == self.interface_name:
-			result = {}
-			
-			for prop in self.export_properties:
-				try:
-					result[prop[0].upper() + prop[1:]] = getattr(self, prop)
-				except:
-					pass
-			
-			return result
+			return self.get_properties()
 		else:
-			raise Exception(
-				"org.semplicelinux.usersd.UnknownInterface",
-				"The object does not implement the %s interface" % interface_name
+			raise dbus.exceptions.DBusException(
+				"The object does not implement the %s interface" % interface_name,
+				name="org.freedesktop.DBus.Error.UnknownInterface"
 			)
 	
 	@outside_timeout(
 		dbus_interface=dbus.PROPERTIES_IFACE,
 		in_signature="ssv",
 		sender_keyword="sender",
-		connection_keyword="connection"
+		connection_keyword="connection",
+		async_callbacks=("reply_handler", "error_handler")
 	)
-	def Set(self, interface_name, property_name, new_value, sender=None, connection=None):
+	def Set(self, interface_name, property_name, new_value, sender=None, connection=None, reply_handler=None, error_handler=None):
 		"""
 		An implementation of the Set() method of the
 		properties interface.
+		
+		The authorization is checked without blocking the main loop.
 		"""
 		
-		if sender and connection and not get_user(sender) in self.set_privileges and (self.polkit_policy and not is_authorized(
-			sender,
-			connection,
-			self.polkit_policy,
-			True # user interaction
-		)):
-			raise Exception("E: Not authorized")
+		def on_authorization_checked(authorized):
+			"""
+			Fired when the authorization check completed.
+			"""
+			
+			if not authorized:
+				error_handler(Exception("E: Not authorized"))
+				return
+			
+			try:
+				self.store_property(property_name, new_value)
+			except Exception as err:
+				error_handler(err)
+			else:
+				reply_handler()
+		
+		def on_credentials(credentials):
+			"""
+			Fired when the credentials of the sender are known.
+			"""
+			
+			if credentials["UnixUserID"] in self.set_privileges:
+				on_authorization_checked(True)
+			else:
+				is_authorized_async(
+					sender,
+					connection,
+					self.polkit_policy,
+					True, # user interaction
+					on_authorization_checked
+				)
 		
-		self.store_property(property_name, new_value)
+		if sender and connection and self.polkit_policy:
+			credentials_cache.get_async(sender, on_credentials, error_handler)
+		else:
+			on_authorization_checked(True)
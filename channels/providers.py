@@ -19,10 +19,152 @@
 #    Eugenio "g7" Paolantonio <me@medesimo.eu>
 #
 
+import channels.common
 from channels.common import CURRENT_HANDLER, discovery, actions
 
 import channels.actions
 
+from threading import Lock
+
+class ProviderIndex:
+	
+	"""
+	A reverse index of the discovery cache, that maps every provider to
+	the channels that provide it.
+	
+	The index is built once per discovery generation, and then updated
+	incrementally when the discovery cache changes.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the class.
+		"""
+		
+		self.lock = Lock()
+		
+		self.generation = None
+		
+		# Available providers (the .provider entries)
+		self.entries = set()
+		
+		# provider -> set of channels
+		self.providers = {}
+		
+		# channel -> providers of the channel (to update the index
+		# when the channel changes)
+		self.channel_providers = {}
+		
+		# Sorted lists, built on request
+		self.sorted_providers = None
+		self.sorted_channels = {}
+		
+		channels.common.discovery_listeners.append(self.on_discovery_changed)
+	
+	def add_entry(self, name, obj):
+		"""
+		Adds the given discovery cache entry to the index.
+		"""
+		
+		if name.endswith(".provider"):
+			self.entries.add(name)
+			return
+		
+		self.channel_providers[name] = obj.get_providers()
+		for provider in self.channel_providers[name]:
+			self.providers.setdefault(provider, set()).add(name)
+	
+	def remove_entry(self, name):
+		"""
+		Removes the given discovery cache entry from the index.
+		"""
+		
+		self.entries.discard(name)
+		
+		for provider in self.channel_providers.pop(name, []):
+			if provider in self.providers:
+				self.providers[provider].discard(name)
+	
+	def build(self):
+		"""
+		Builds the index from scratch.
+		"""
+		
+		self.entries = set()
+		self.providers = {}
+		self.channel_providers = {}
+		
+		for name, obj in discovery.cache.items():
+			self.add_entry(name, obj)
+		
+		self.sorted_providers = None
+		self.sorted_channels = {}
+		self.generation = channels.common.generation
+	
+	def on_discovery_changed(self, changed):
+		"""
+		Updates the index with the changed entries.
+		"""
+		
+		with self.lock:
+			if self.generation is None:
+				# Not yet built
+				return
+			
+			for name in changed:
+				self.remove_entry(name)
+				if name in discovery.cache:
+					self.add_entry(name, discovery.cache[name])
+			
+			self.sorted_providers = None
+			self.sorted_channels = {}
+			self.generation = channels.common.generation
+	
+	def ensure(self):
+		"""
+		Builds the index if it's missing or stale.
+		"""
+		
+		if self.generation != channels.common.generation:
+			self.build()
+	
+	def get_providers(self):
+		"""
+		Returns a sorted list of every available provider.
+		"""
+		
+		with self.lock:
+			self.ensure()
+			
+			if self.sorted_providers is None:
+				self.sorted_providers = sorted(self.entries)
+			
+			return self.sorted_providers
+	
+	def get_channels(self, provider):
+		"""
+		Returns a sorted list of the channels that provide the given provider.
+		"""
+		
+		with self.lock:
+			self.ensure()
+			
+			if not provider in self.sorted_channels:
+				self.sorted_channels[provider] = sorted(self.providers.get(provider, ()))
+			
+			return self.sorted_channels[provider]
+	
+	def get_map(self):
+		"""
+		Returns a dictionary that maps every provider to the sorted list
+		of the channels that provide it.
+		"""
+		
+		return {
+			provider:self.get_channels(provider)
+			for provider in self.get_providers()
+		}
+
 class Providers:
 	
 	"""
@@ -39,6 +181,9 @@ class Providers:
 		
 		pass
 	
+	# Shared between every instance
+	index = ProviderIndex()
+	
 	@channels.actions.action(
 		command="list-providers",
 		help="Lists every available provider",
@@ -50,11 +195,7 @@ class Providers:
 		Lists every available channel.
 		"""
 		
-		return sorted([
-			provider
-			for provider, obj in discovery.cache.items()
-			if provider.endswith(".provider")
-		])
+		return list(self.index.get_providers())
 	
 	@channels.actions.action(
 		command="what-provides",
@@ -70,10 +211,26 @@ class Providers:
 		
 		if not provider.endswith(".provider"): provider += ".provider"
 		
-		return sorted([
+		return [
 			channel if CURRENT_HANDLER == "DBus" else (
-				"%s%s" % (channel, " (enabled)" if obj.enabled else "")
+				"%s%s" % (channel, " (enabled)" if discovery.cache[channel].enabled else "")
 			)
-			for channel, obj in discovery.cache.items()
-			if not channel.endswith(".provider") and provider in obj.get_providers()
-		])
+			for channel in self.index.get_channels(provider)
+		]
+	
+	@channels.actions.action(
+		command="provider-map",
+		help="Lists every available provider, alongside the channels that provide it",
+		cli_output="keyvalue",
+		out_signature="a{sas}"
+	)
+	def GetProviderMap(self):
+		"""
+		Returns a dictionary that maps every available provider to the
+		channels that provide it.
+		"""
+		
+		return {
+			provider:(channel_list if CURRENT_HANDLER == "DBus" else ", ".join(channel_list))
+			for provider, channel_list in self.index.get_map().items()
+		}
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import stat
+
+import pickle
+
+import tempfile
+
+import logging
+
+import importlib.util
+
+logger = logging.getLogger(__name__)
+
+# Where the snapshot is stored
+SNAPSHOT_PATH = "/var/cache/channels/discovery.snapshot"
+
+# Bump this when the snapshot format changes
+SNAPSHOT_VERSION = 1
+
+# The apt sources, which determine the enabled state of channels and
+# components
+APT_SOURCES_PATHS = [
+	"/etc/apt/sources.list",
+	"/etc/apt/sources.list.d",
+]
+
+def get_watched_paths():
+	"""
+	Returns the files and directories that, when changed, invalidate
+	the discovery: the paths searched by libchannels' discovery for
+	channel and provider definitions, and the apt sources.
+	
+	Returns None if libchannels doesn't expose its search paths.
+	"""
+	
+	import libchannels.discovery
+	
+	search_paths = getattr(libchannels.discovery, "SEARCH_PATHS", None)
+	if search_paths is None:
+		logger.warning("libchannels doesn't expose its discovery search paths")
+		return None
+	elif isinstance(search_paths, str):
+		search_paths = [search_paths]
+	
+	return list(search_paths) + APT_SOURCES_PATHS
+
+def _stat(path):
+	"""
+	Returns the (mtime, size) tuple of the given path, or None if
+	it doesn't exist.
+	"""
+	
+	try:
+		infos = os.stat(path)
+	except OSError:
+		return None
+	
+	return (infos.st_mtime_ns, infos.st_size)
+
+def _library_paths():
+	"""
+	Returns the directories of the libchannels package, without
+	importing it.
+	"""
+	
+	try:
+		spec = importlib.util.find_spec("libchannels")
+	except (ImportError, ValueError):
+		return []
+	
+	if spec is None:
+		return []
+	elif spec.submodule_search_locations:
+		return list(spec.submodule_search_locations)
+	elif spec.origin:
+		return [spec.origin]
+	
+	return []
+
+def fingerprint(paths=None):
+	"""
+	Returns a dictionary that maps every file (and directory) under the
+	given paths (by default, get_watched_paths()) to its (mtime, size)
+	tuple, or None if the paths are not known: in that case, the
+	snapshot is not used.
+	
+	Directories are included too, so that added and removed files
+	are detected.
+	
+	The libchannels modules are included as well: the snapshot pickles
+	libchannels objects, so it must not outlive an upgrade of the
+	library that changes their layout.
+	"""
+	
+	if paths is None:
+		paths = get_watched_paths()
+		if paths is None:
+			return None
+	
+	result = {}
+	
+	for path in list(paths) + _library_paths():
+		result[path] = _stat(path)
+		
+		if os.path.isdir(path):
+			for directory, dirs, files in os.walk(path):
+				# Bytecode caches change on their own
+				dirs[:] = [x for x in dirs if x != "__pycache__"]
+				
+				result[directory] = _stat(directory)
+				for name in files:
+					name = os.path.join(directory, name)
+					result[name] = _stat(name)
+	
+	return result
+
+def load(current_fingerprint, path=SNAPSHOT_PATH):
+	"""
+	Returns the discovery object stored in the snapshot, or None if
+	the snapshot is missing, untrusted or outdated.
+	"""
+	
+	if current_fingerprint is None:
+		return None
+	
+	try:
+		with open(path, "rb") as f:
+			infos = os.fstat(f.fileno())
+			
+			# The snapshot is unpickled, so trust it only if it's
+			# owned by root (or by us) and nobody else can write it.
+			if (
+				infos.st_uid not in (0, os.geteuid()) or
+				infos.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+			):
+				logger.warning("Ignoring untrusted discovery snapshot %s" % path)
+				return None
+			
+			snapshot = pickle.load(f)
+	except FileNotFoundError:
+		return None
+	except Exception as err:
+		logger.warning("Unable to load discovery snapshot: %s" % err)
+		return None
+	
+	if (
+		not isinstance(snapshot, dict) or
+		snapshot.get("version") != SNAPSHOT_VERSION or
+		snapshot.get("fingerprint") != current_fingerprint
+	):
+		return None
+	
+	return snapshot.get("discovery")
+
+def store(discovery, current_fingerprint, path=SNAPSHOT_PATH):
+	"""
+	Stores the given discovery object in the snapshot.
+	
+	`current_fingerprint` should be the fingerprint taken *before*
+	the discovery ran, so that changes made in the meantime invalidate
+	the snapshot on the next load.
+	
+	Returns True if the snapshot has been stored, False if not (for
+	example when the user can't write to the snapshot directory).
+	"""
+	
+	if current_fingerprint is None:
+		return False
+	
+	directory = os.path.dirname(path)
+	
+	try:
+		if not os.path.exists(directory):
+			os.makedirs(directory, 0o755)
+		
+		# Write the snapshot atomically
+		fd, temp = tempfile.mkstemp(dir=directory, prefix=".discovery.")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump(
+					{
+						"version" : SNAPSHOT_VERSION,
+						"fingerprint" : current_fingerprint,
+						"discovery" : discovery
+					},
+					f,
+					pickle.HIGHEST_PROTOCOL
+				)
+			os.chmod(temp, 0o644)
+			os.replace(temp, path)
+		except:
+			os.remove(temp)
+			raise
+	except PermissionError:
+		# Unprivileged user, nothing to do
+		return False
+	except Exception as err:
+		logger.warning("Unable to store discovery snapshot: %s" % err)
+		return False
+	
+	return True
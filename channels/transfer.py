@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import math
+
+import time
+
+import collections
+
+from threading import Lock
+
+# Time constant, in seconds, of the smoothed throughput: older samples
+# weigh 1/e after this time
+TRANSFER_RATE_TIME_CONSTANT = 5
+
+# Number of rate samples and item durations kept
+TRANSFER_HISTORY_LENGTH = 60
+
+class TransferStats:
+	"""
+	Statistics of a transfer, fed by an acquire progress.
+	
+	The throughput is smoothed with an exponentially weighted moving
+	average whose weight depends on the time elapsed between samples,
+	so that irregular pulses don't skew it.
+	"""
+	
+	def __init__(self, history=TRANSFER_HISTORY_LENGTH):
+		"""
+		Initializes the class.
+		"""
+		
+		self.lock = Lock()
+		
+		self.history_length = history
+		
+		self.reset()
+	
+	def reset(self):
+		"""
+		Clears the statistics.
+		"""
+		
+		with self.lock:
+			self.running = False
+			self.started = None
+			
+			self.current_bytes = 0
+			self.total_bytes = 0
+			
+			# Smoothed throughput, in bytes per second
+			self.rate = 0.0
+			
+			# (time since start, rate) samples
+			self.rate_history = collections.deque(maxlen=self.history_length)
+			
+			# uri -> start time, of the items being fetched
+			self.items = {}
+			
+			# (description, seconds, failed) of the last items
+			self.item_durations = collections.deque(maxlen=self.history_length)
+			
+			self._last_time = None
+			self._last_bytes = 0
+	
+	def start(self):
+		"""
+		Starts a new transfer.
+		"""
+		
+		self.reset()
+		
+		with self.lock:
+			self.running = True
+			self.started = self._last_time = time.monotonic()
+	
+	def stop(self):
+		"""
+		Stops the transfer. The statistics are kept until the next start.
+		"""
+		
+		with self.lock:
+			self.running = False
+			self.items = {}
+	
+	def update(self, current_bytes, total_bytes):
+		"""
+		Adds a sample. Should be called at every pulse.
+		"""
+		
+		now = time.monotonic()
+		
+		with self.lock:
+			if self._last_time is None:
+				self._last_time = self.started = now
+			
+			elapsed = now - self._last_time
+			transferred = current_bytes - self._last_bytes
+			
+			self.current_bytes = current_bytes
+			self.total_bytes = total_bytes
+			
+			if transferred < 0:
+				# APT restarted or shrank the transfer: start over from
+				# this sample, without feeding a bogus rate
+				self._last_time = now
+				self._last_bytes = current_bytes
+				return
+			elif elapsed <= 0:
+				return
+			
+			sample = transferred / elapsed
+			weight = 1 - math.exp(-elapsed / TRANSFER_RATE_TIME_CONSTANT)
+			
+			self.rate = (
+				sample
+				if not self.rate_history else
+				self.rate + weight * (sample - self.rate)
+			)
+			self.rate_history.append((now - self.started, self.rate))
+			
+			self._last_time = now
+			self._last_bytes = current_bytes
+	
+	def item_started(self, uri):
+		"""
+		Records the start of the fetch of the given item.
+		"""
+		
+		with self.lock:
+			self.items[uri] = time.monotonic()
+	
+	def item_finished(self, uri, description, failed=False):
+		"""
+		Records the end of the fetch of the given item.
+		"""
+		
+		with self.lock:
+			started = self.items.pop(uri, None)
+			if started is not None:
+				self.item_durations.append(
+					(description, time.monotonic() - started, failed)
+				)
+	
+	@property
+	def remaining_bytes(self):
+		"""
+		Returns the number of bytes left to transfer.
+		"""
+		
+		return max(self.total_bytes - self.current_bytes, 0)
+	
+	@property
+	def eta(self):
+		"""
+		Returns the estimated number of seconds left, or None if it's
+		not known.
+		"""
+		
+		with self.lock:
+			if not self.running or self.rate <= 0:
+				return None
+			
+			return self.remaining_bytes / self.rate
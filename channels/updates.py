@@ -29,7 +29,11 @@ else:
 
 import channels.actions
 
-import apt.progress.base, apt.progress.text
+from channels.acquire import AcquireSettings, parse_options
+from channels.transfer import TransferStats
+from channels.metrics import registry
+
+import apt.cache, apt.progress.base, apt.progress.text
 
 import os
 
@@ -39,13 +43,23 @@ import shutil
 
 import math
 
+import time
+
 import logging
 
 import pwd
 
+import apt_pkg
+
 from apt_pkg import size_to_str
 
-from threading import Lock
+import itertools
+
+import collections
+
+import contextlib
+
+from threading import Lock, Event
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +69,453 @@ logger = logging.getLogger(__name__)
 
 APT_LOGFILE = "/var/log/channels/systemupdate.log"
 
+# Minimum interval, in seconds, between two progress signals
+PROGRESS_RATE_LIMIT = 0.25
+
+# Maximum number of updates sent with a single UpdatesFound signal
+UPDATES_CHUNK_SIZE = 500
+
+# Cache operation priorities (lower runs first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# Burst allowed by the bandwidth throttling, in seconds of transfer
+THROTTLE_BURST = 1
+
+# Maximum time, in seconds, a single acquire pulse is held back by the
+# bandwidth throttling (the remaining debt is paid on the next pulses)
+THROTTLE_MAX_DELAY = 0.5
+
+# Seconds to wait for the background prefetch to stop, before an
+# operation that needs the APT locks starts anyway
+PREFETCH_STOP_TIMEOUT = 5
+
+def get_apt_duration(operation):
+	"""
+	Returns the histogram of the durations of the given APT operation
+	("cache-open", "refresh", "fetch", "prefetch" or "install").
+	"""
+	
+	return registry.histogram(
+		"channels_apt_duration_seconds",
+		"Time spent in APT operations",
+		operation=operation
+	)
+
+def _quote_archive_field(value, bad):
+	"""
+	Quotes the given field of an archive file name, as APT does.
+	"""
+	
+	return "".join(
+		"%%%02x" % ord(char)
+		if char in bad or char == "%" or ord(char) <= 0x20 or ord(char) >= 0x7f else
+		char
+		for char in value
+	)
+
+def get_archive_name(version):
+	"""
+	Returns the file name of the archive of the given
+	apt.package.Version in APT's archive cache.
+	"""
+	
+	return "%s_%s_%s.deb" % (
+		_quote_archive_field(version.package.name, "_:"),
+		_quote_archive_field(version.version, "_:"),
+		_quote_archive_field(version.architecture, "_:.")
+	)
+
+def get_cached_archives():
+	"""
+	Returns a dictionary that maps the name of every archive in APT's
+	archive cache to its size, with a single directory read.
+	"""
+	
+	result = {}
+	
+	try:
+		with os.scandir(apt_pkg.config.find_dir("Dir::Cache::Archives")) as entries:
+			for entry in entries:
+				if entry.name.endswith(".deb") and entry.is_file():
+					result[entry.name] = entry.stat().st_size
+	except OSError as err:
+		logger.warning("Unable to read the archive cache: %s" % err)
+	
+	return result
+
+def is_archive_cached(version, cached_archives=None):
+	"""
+	Returns True if the archive of the given apt.package.Version has
+	already been downloaded to APT's archive cache.
+	
+	`cached_archives`, if given, is the result of get_cached_archives().
+	"""
+	
+	name = get_archive_name(version)
+	
+	if cached_archives is not None:
+		return cached_archives.get(name) == version.size
+	
+	try:
+		return os.path.getsize(
+			os.path.join(apt_pkg.config.find_dir("Dir::Cache::Archives"), name)
+		) == version.size
+	except OSError:
+		return False
+
+class CacheOperation:
+	"""
+	An operation submitted to the CacheOperationScheduler.
+	"""
+	
+	def __init__(self, id, name, key, priority, func, args, barrier=False):
+		"""
+		Initializes the operation.
+		"""
+		
+		self.id = id
+		self.name = name
+		self.key = key
+		self.priority = priority
+		self.func = func
+		self.args = args
+		
+		# True if the operation invalidates the cache state (e.g. the
+		# marks) the operations queued after it work on
+		self.barrier = barrier
+		
+		# Called to interrupt the operation while it's running, when
+		# another operation is queued
+		self.preempt = None
+		
+		# "queued", "running", "done", "failed" or "cancelled"
+		self.state = "queued"
+		
+		self.queued_at = time.monotonic()
+
+class CacheOperationScheduler:
+	"""
+	Runs the operations on the APT cache one at a time, by priority.
+	
+	Queued operations with the same key are merged: the queued one is
+	updated with the new arguments (and with the highest priority of
+	the two). Queued operations can be cancelled.
+	
+	A running operation submitted with a `preempt` callback is
+	interrupted as soon as another operation (with a different key) is
+	queued, whatever its priority.
+	
+	Barrier operations (e.g. a refresh, which clears the marks) are
+	never overtaken by the operations queued after them, whatever
+	their priority, and queued operations are not merged across them.
+	
+	Operations are run by a job on the shared job queue, which is
+	started when the first operation is queued and exits when there
+	are no more operations.
+	
+	On the cli handler, operations are run immediately.
+	"""
+	
+	def __init__(self, history=32):
+		"""
+		Initializes the scheduler.
+		"""
+		
+		self.lock = Lock()
+		
+		self.ids = itertools.count(1)
+		
+		# id -> queued operation
+		self.queued = {}
+		
+		# key -> queued operation
+		self.keys = {}
+		
+		self.current = None
+		self.finished = collections.deque(maxlen=history)
+		
+		self.draining = False
+	
+	@property
+	def busy(self):
+		"""
+		True if there are queued or running operations, False if not.
+		"""
+		
+		with self.lock:
+			return bool(self.queued or self.current)
+	
+	def get_operations(self):
+		"""
+		Returns a list of (id, name, priority, state) tuples for every
+		queued, running and recently finished operation.
+		"""
+		
+		with self.lock:
+			return [
+				(op.id, op.name, op.priority, op.state)
+				for op in itertools.chain(
+					self.finished,
+					[self.current] if self.current else [],
+					sorted(self.queued.values(), key=lambda x: (x.priority, x.id))
+				)
+			]
+	
+	def _get_barrier(self):
+		"""
+		Returns the id of the first queued barrier operation, or None.
+		
+		Must be called with the lock held.
+		"""
+		
+		return min(
+			(op.id for op in self.queued.values() if op.barrier),
+			default=None
+		)
+	
+	def submit(self, name, func, args=(), priority=PRIORITY_NORMAL, key=None, merge=None, preempt=None, barrier=False):
+		"""
+		Queues the given operation, and returns its CacheOperation.
+		
+		If an operation with the same key is already queued (and not
+		followed by a barrier), it is updated and returned instead.
+		`merge`, if specified, is called with the queued and the new
+		arguments and returns the merged ones (by default, the new
+		arguments win).
+		
+		If `barrier` is True, the operations queued afterwards wait
+		for this one (see CacheOperationScheduler).
+		"""
+		
+		if CURRENT_HANDLER != "DBus":
+			func(*args)
+			return None
+		
+		with self.lock:
+			if (
+				self.current is not None and
+				self.current.preempt is not None and
+				(key is None or key != self.current.key)
+			):
+				logger.debug("Operation %s preempts %d" % (name, self.current.id))
+				self.current.preempt()
+			
+			if key is not None and key in self.keys and not any(
+				other.barrier and other.id > self.keys[key].id
+				for other in self.queued.values()
+			):
+				op = self.keys[key]
+				op.priority = min(op.priority, priority)
+				op.args = merge(op.args, args) if merge else args
+				
+				logger.debug("Operation %s merged with %d" % (name, op.id))
+				return op
+			
+			op = CacheOperation(next(self.ids), name, key, priority, func, args, barrier)
+			op.preempt = preempt
+			
+			self.queued[op.id] = op
+			if key is not None:
+				self.keys[key] = op
+			
+			if not self.draining:
+				try:
+					channels.common.job_queue.submit(self.drain, name="cache-operations")
+				except:
+					del self.queued[op.id]
+					self.keys.pop(key, None)
+					raise
+				
+				self.draining = True
+		
+		return op
+	
+	def cancel(self, id):
+		"""
+		Cancels the given queued operation.
+		
+		Returns True if the operation has been cancelled, False if it's
+		not queued.
+		"""
+		
+		with self.lock:
+			op = self.queued.pop(id, None)
+			if op is None:
+				return False
+			
+			if self.keys.get(op.key) is op:
+				del self.keys[op.key]
+			
+			op.state = "cancelled"
+			op.func = op.args = None
+			self.finished.append(op)
+		
+		return True
+	
+	def drain(self):
+		"""
+		Runs the queued operations, by priority, until there are no more.
+		"""
+		
+		while True:
+			with self.lock:
+				if not self.queued:
+					self.draining = False
+					return
+				
+				# Operations queued after a barrier wait for it
+				barrier = self._get_barrier()
+				op = min(
+					(
+						x
+						for x in self.queued.values()
+						if barrier is None or x.id <= barrier
+					),
+					key=lambda x: (x.priority, x.id)
+				)
+				del self.queued[op.id]
+				if self.keys.get(op.key) is op:
+					del self.keys[op.key]
+				
+				op.state = "running"
+				self.current = op
+			
+			started = time.monotonic()
+			registry.histogram(
+				"channels_cache_operation_wait_seconds",
+				"Time cache operations spent queued, waiting for the APT cache",
+				operation=op.name
+			).observe(started - op.queued_at)
+			
+			try:
+				op.func(*op.args)
+			except Exception as err:
+				logger.error("Cache operation %d (%s) failed: %s" % (op.id, op.name, err))
+				op.state = "failed"
+			else:
+				op.state = "done"
+			
+			registry.histogram(
+				"channels_cache_operation_duration_seconds",
+				"Time spent running cache operations",
+				operation=op.name
+			).observe(time.monotonic() - started)
+			
+			with self.lock:
+				self.current = None
+				op.func = op.args = None
+				self.finished.append(op)
+
+class UpdateAccounting:
+	"""
+	Keeps the required download and disk space totals of the marked
+	packages, with per-package contributions.
+	
+	`exact` is False when some marked packages couldn't be attributed
+	to the update list: in that case, totals should be computed again
+	from scratch.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the class.
+		"""
+		
+		self.lock = Lock()
+		
+		# id -> (name, download, space)
+		self.contributions = {}
+		
+		self.download = 0
+		self.space = 0
+		
+		# Nothing is marked yet
+		self.exact = True
+	
+	def clear(self):
+		"""
+		Clears every contribution.
+		"""
+		
+		with self.lock:
+			self.contributions = {}
+			self.download = 0
+			self.space = 0
+			self.exact = True
+	
+	def update(self, contributions, exact):
+		"""
+		Replaces every contribution with the given ones (a dictionary
+		that maps an id to a (name, download, space) tuple).
+		"""
+		
+		with self.lock:
+			self.contributions = contributions
+			self.download = sum(x[1] for x in contributions.values())
+			self.space = sum(x[2] for x in contributions.values())
+			self.exact = exact
+	
+	def apply(self, contributions, removed, marked):
+		"""
+		Sets the given contributions (a dictionary that maps an id to a
+		(name, download, space) tuple) and removes the given ids, in
+		O(changes).
+		
+		`marked` is the number of marked packages: if it doesn't match
+		the resulting number of contributions, some changes couldn't be
+		attributed, nothing is changed and False is returned.
+		"""
+		
+		with self.lock:
+			count = (
+				len(self.contributions) +
+				len([id for id in contributions if not id in self.contributions]) -
+				len([id for id in removed if id in self.contributions and not id in contributions])
+			)
+			if count != marked:
+				return False
+			
+			for id in removed:
+				if id in self.contributions and not id in contributions:
+					name, download, space = self.contributions.pop(id)
+					self.download -= download
+					self.space -= space
+			
+			for id, (name, download, space) in contributions.items():
+				if id in self.contributions:
+					self.download -= self.contributions[id][1]
+					self.space -= self.contributions[id][2]
+				
+				self.contributions[id] = (name, download, space)
+				self.download += download
+				self.space += space
+			
+			self.exact = True
+		
+		return True
+	
+	def get_totals(self):
+		"""
+		Returns a (required download, required space) tuple.
+		"""
+		
+		with self.lock:
+			return self.download, self.space
+	
+	def get_breakdown(self):
+		"""
+		Returns a list of (id, name, download, space) tuples, one for
+		every package that contributes to the totals.
+		"""
+		
+		with self.lock:
+			return [
+				(id, name, download, space)
+				for id, (name, download, space) in sorted(self.contributions.items())
+			]
+
 class DBusOpProgress(apt.progress.base.OpProgress):
 	"""
 	An OpProgress variant ready to be used on DBus.
@@ -69,12 +530,18 @@ class DBusOpProgress(apt.progress.base.OpProgress):
 		
 		self.on_changed = on_changed
 		self.on_done = on_done
+		
+		self.started = None
 	
 	def done(self):
 		"""
 		Fires the signal, with 100 as percentage.
 		"""
 		
+		if self.started is not None:
+			get_apt_duration("cache-open").observe(time.monotonic() - self.started)
+			self.started = None
+		
 		self.on_done()
 	
 	def update(self):
@@ -82,21 +549,172 @@ class DBusOpProgress(apt.progress.base.OpProgress):
 		Fires the signal with the current percentage.
 		"""
 		
+		if self.started is None:
+			self.started = time.monotonic()
+		
 		if self.major_change:
 			self.on_changed(self.op, self.subop, self.percent)
 
-class DBusAcquireProgress(apt.progress.base.AcquireProgress):
+class TokenBucket:
 	"""
-	An AcquireProgress variant ready to be used on DBus.
+	A token bucket, used to limit the bandwidth.
+	
+	Tokens (bytes) are added at the given rate, up to THROTTLE_BURST
+	seconds worth of them. The rate is given at every consume() call,
+	so that it can be changed at any time.
+	"""
+	
+	def __init__(self):
+		"""
+		Initializes the class.
+		"""
+		
+		self.reset()
+	
+	def reset(self):
+		"""
+		Empties the bucket.
+		"""
+		
+		self.tokens = 0
+		self.last = time.monotonic()
+	
+	def consume(self, amount, rate):
+		"""
+		Takes the given amount of tokens from the bucket, and returns
+		the number of seconds to wait before the transfer can continue
+		at the given rate (bytes per second, 0 for no limit).
+		"""
+		
+		now = time.monotonic()
+		elapsed, self.last = now - self.last, now
+		
+		if rate <= 0:
+			self.tokens = 0
+			return 0
+		
+		self.tokens = min(rate * THROTTLE_BURST, self.tokens + elapsed * rate) - amount
+		
+		return -self.tokens / rate if self.tokens < 0 else 0
+
+class ThrottledAcquireProgress(apt.progress.base.AcquireProgress):
+	"""
+	An AcquireProgress that limits the bandwidth of the transfer to
+	the current rate-limit, and keeps its statistics (see
+	TransferStats) in `stats`.
+	
+	The APT methods cap their own bandwidth with Dl-Limit, which they
+	read when they start (see the rate-limit acquire setting). The
+	limit is read again at every pulse here, so that a change applies
+	to the running transfer too: holding back pulse() stops APT from
+	reading from its methods and from starting the next items, until
+	the transfer as a whole is back within the limit.
 	"""
 	
-	def __init__(self, on_start, on_stop, on_done, on_fail, on_fetch):
+	def __init__(self, get_rate_limit=None):
 		"""
 		Initializes the class.
+		
+		`get_rate_limit` is called at every pulse, and returns the
+		current limit in bytes per second (0 for no limit).
 		"""
 		
 		super().__init__()
 		
+		self.get_rate_limit = get_rate_limit
+		
+		self.bucket = TokenBucket()
+		self.stats = TransferStats()
+		
+		self._last_bytes = 0
+	
+	def start(self):
+		"""
+		Resets the throttling state and the statistics.
+		"""
+		
+		super().start()
+		
+		self.bucket.reset()
+		self.stats.start()
+		
+		self._last_bytes = 0
+	
+	def stop(self):
+		"""
+		Stops the statistics.
+		"""
+		
+		super().stop()
+		
+		self.stats.update(self.current_bytes, self.total_bytes)
+		self.stats.stop()
+	
+	def fetch(self, item):
+		"""
+		Records the start of the item.
+		"""
+		
+		super().fetch(item)
+		
+		self.stats.item_started(item.uri)
+	
+	def done(self, item):
+		"""
+		Records the end of the item.
+		"""
+		
+		super().done(item)
+		
+		self.stats.item_finished(item.uri, item.shortdesc)
+	
+	def fail(self, item):
+		"""
+		Records the failure of the item.
+		"""
+		
+		super().fail(item)
+		
+		self.stats.item_finished(item.uri, item.shortdesc, failed=True)
+	
+	def pulse(self, owner):
+		"""
+		Throttles the transfer, if a limit is set.
+		"""
+		
+		# current_bytes can go back (e.g. when APT restarts an item)
+		transferred = max(self.current_bytes - self._last_bytes, 0)
+		self._last_bytes = self.current_bytes
+		
+		if self.get_rate_limit is not None:
+			delay = self.bucket.consume(transferred, self.get_rate_limit() or 0)
+			if delay > 0:
+				time.sleep(min(delay, THROTTLE_MAX_DELAY))
+		
+		# Sample after the delay, so that the throttled rate is measured
+		self.stats.update(self.current_bytes, self.total_bytes)
+		
+		return super().pulse(owner)
+
+class TextAcquireProgress(ThrottledAcquireProgress, apt.progress.text.AcquireProgress):
+	"""
+	The text AcquireProgress, with bandwidth throttling.
+	"""
+	
+	pass
+
+class DBusAcquireProgress(ThrottledAcquireProgress):
+	"""
+	An AcquireProgress variant ready to be used on DBus.
+	"""
+	
+	def __init__(self, on_start, on_stop, on_done, on_fail, on_fetch, get_rate_limit=None):
+		"""
+		Initializes the class.
+		"""
+		
+		super().__init__(get_rate_limit)
+		
 		self.on_start = on_start
 		self.on_stop = on_stop
 		self.on_done = on_done
@@ -110,6 +728,8 @@ class DBusAcquireProgress(apt.progress.base.AcquireProgress):
 		Fires the on_start signal.
 		"""
 		
+		super().start()
+		
 		self.on_start()
 		
 		self._current_id = 0
@@ -119,6 +739,8 @@ class DBusAcquireProgress(apt.progress.base.AcquireProgress):
 		Fires the on_stop signal.
 		"""
 		
+		super().stop()
+		
 		self.on_stop()
 	
 	def done(self, item):
@@ -126,6 +748,8 @@ class DBusAcquireProgress(apt.progress.base.AcquireProgress):
 		Fires the done signal.
 		"""
 		
+		super().done(item)
+		
 		# Skip items without id
 		if item.owner.id == 0:
 			return
@@ -137,6 +761,8 @@ class DBusAcquireProgress(apt.progress.base.AcquireProgress):
 		Fires the fail signal.
 		"""
 		
+		super().fail(item)
+		
 		# Skip items without id
 		if item.owner.id == 0:
 			# FIXME: This should be logged!
@@ -149,6 +775,8 @@ class DBusAcquireProgress(apt.progress.base.AcquireProgress):
 		Fires the fetch signal.
 		"""
 		
+		super().fetch(item)
+		
 		# Set an id only if missing
 		if item.owner.id == 0:
 			self._current_id += 1
@@ -165,7 +793,35 @@ class DBusAcquireProgress(apt.progress.base.AcquireProgress):
 			self.stop_requested = False
 			return False
 		
-		return True	
+		return super().pulse(owner)
+
+class PrefetchProgress(ThrottledAcquireProgress):
+	"""
+	The AcquireProgress of the background prefetch. It's silent, and
+	stops the transfer when paused.
+	
+	The prefetch is throttled to the rate-limit acquire setting, like
+	every other transfer.
+	"""
+	
+	def __init__(self, get_rate_limit=None):
+		"""
+		Initializes the class.
+		"""
+		
+		super().__init__(get_rate_limit)
+		
+		self.paused = False
+	
+	def pulse(self, owner):
+		"""
+		Determines if the acquire process should continue.
+		"""
+		
+		if self.paused:
+			return False
+		
+		return super().pulse(owner)
 
 class DBusInstallProgress(apt.progress.base.InstallProgress):
 	"""
@@ -284,24 +940,80 @@ class Updates:
 		"cacheFailure",
 		"CurrentDownloadRate",
 		"CurrentDownloadETA",
+		"CurrentDownloadRateBytes",
+		"CurrentDownloadETASeconds",
+		"CurrentDownloadedBytes",
+		"CurrentDownloadTotalBytes",
+		"JobQueueDepth",
+		"AcquirePipelineDepth",
+		"AcquireQueueHostLimit",
+		"AcquireQueueMode",
+		"BackgroundPrefetch",
+		"DownloadRateLimit",
+		"prefetching",
 	]
 	
+	# Required to change the acquire settings
+	polkit_policy = "org.semplicelinux.channels.configure-updates"
+	
 	cacheFailure = False
 	cacheOpening = False
 	refreshing = False
 	checking = False
 	downloading = False
 	installing = False
+	prefetching = False
+	
+	# Check the download rate and ETA every second while refreshing
+	# or downloading
+	properties_tick_interval = 1
+	
+	# The download statistics are computed, cache them for a while
+	cached_properties = {
+		"CurrentDownloadRate" : 0.5,
+		"CurrentDownloadETA" : 0.5,
+	}
 	
 	user_lock_count = 0
 	
-	cache_operation_lock = Lock()
+	# The update list found by the last update check
+	update_list = []
 	
-	def __init__(self):
-		"""
+	cache_scheduler = CacheOperationScheduler()
+	
+	# The last consistent (required download, required space) tuple,
+	# computed from scratch. Used when the accounting is not exact.
+	update_infos = (0, 0)
+	
+	# id -> package name, of the packages in the update list
+	package_names = {}
+	
+	# id -> reason, of the user changes after the last mark
+	package_states = {}
+	
+	def __init__(self):
+		"""
 		Initializes the class.
 		"""
 		
+		# Required download and space accounting
+		self.accounting = UpdateAccounting()
+		
+		# Acquire settings
+		self.acquire_settings = AcquireSettings()
+		self.acquire_settings.apply()
+		
+		# Background prefetch
+		self.prefetch_progress = PrefetchProgress(self.get_rate_limit)
+		self.prefetch_inhibitors = 0
+		self.prefetch_stopped = Event()
+		self.prefetch_stopped.set()
+		
+		# Guards prefetch_inhibitors, the pause flag of prefetch_progress
+		# and prefetch_stopped, so that the prefetch never starts while
+		# an operation holds the APT locks
+		self.prefetch_lock = Lock()
+		
 		# Lock failed
 		updates.lock_failure_callback = self.LockFailed
 		
@@ -317,27 +1029,29 @@ class Updates:
 		
 		# Cache update progress
 		updates.cache_acquire_progress = (
-			apt.progress.text.AcquireProgress()
+			TextAcquireProgress(self.get_rate_limit)
 			if CURRENT_HANDLER != "DBus"
 			else DBusAcquireProgress(
 				self.CacheUpdateStarted,
 				self.CacheUpdateStopped,
 				self.CacheUpdateItemDone,
 				self.CacheUpdateItemFailed,
-				self.CacheUpdateItemFetch
+				self.CacheUpdateItemFetch,
+				self.get_rate_limit
 			)
 		)
 		
 		# Package acquire progress
 		updates.packages_acquire_progress = (
-			apt.progress.text.AcquireProgress()
+			TextAcquireProgress(self.get_rate_limit)
 			if CURRENT_HANDLER != "DBus"
 			else DBusAcquireProgress(
 				self.PackageAcquireStarted,
 				self.PackageAcquireStopped,
 				self.PackageAcquireItemDone,
 				self.PackageAcquireItemFailed,
-				self.PackageAcquireItemFetch
+				self.PackageAcquireItemFetch,
+				self.get_rate_limit
 			)
 		)
 		
@@ -458,7 +1172,8 @@ class Updates:
 		pass
 	
 	@channels.actions.signal(
-		signature="d"
+		signature="d",
+		rate_limit=PROGRESS_RATE_LIMIT
 	)
 	def PackageInstallProgressChanged(self, percent):
 		"""
@@ -515,7 +1230,8 @@ class Updates:
 		pass
 	
 	@channels.actions.signal(
-		signature="ssi"
+		signature="ssi",
+		rate_limit=PROGRESS_RATE_LIMIT
 	)
 	def CacheOpenProgress(self, op, subop, percentage):
 		"""
@@ -568,6 +1284,20 @@ class Updates:
 		
 		pass
 	
+	@channels.actions.signal(
+		signature="a(isssss)"
+	)
+	def UpdatesFound(self, update_list):
+		"""
+		Signal emitted with a chunk of the update list, when the update
+		check has been started with CheckUpdatesBulk().
+		
+		Every update is an (id, name, version, reason, status, size)
+		struct, as in UpdateFound.
+		"""
+		
+		pass
+	
 	@channels.actions.signal()
 	def PackageStatusChanged(self, id, reason):
 		"""
@@ -575,41 +1305,163 @@ class Updates:
 		
 		When the reason is "keep", the package has been kept: the UI
 		should handle that (for example, by unticking a checkbox).
+		
+		Only packages whose status actually changed are reported.
+		"""
+		
+		pass
+	
+	@channels.actions.signal(
+		signature="a(is)"
+	)
+	def PackageStatusesChanged(self, changes):
+		"""
+		Signal emitted once per ChangeStatus(), with every package whose
+		status has been changed as an (id, reason) struct.
+		
+		It carries the same changes of PackageStatusChanged(), so UIs
+		should listen to only one of them.
 		"""
 		
 		pass
 	
+	def should_tick_properties(self):
+		"""
+		Returns True if the download rate and ETA may change.
+		"""
+		
+		return self.refreshing or self.downloading
+	
+	@property
+	def AcquirePipelineDepth(self):
+		"""
+		Returns the HTTP pipeline depth, or -1 if APT's default is used.
+		"""
+		
+		value = self.acquire_settings.get("pipeline-depth")
+		
+		return value if value is not None else -1
+	
+	@property
+	def AcquireQueueHostLimit(self):
+		"""
+		Returns the maximum number of concurrent connections, or -1 if
+		APT's default is used.
+		"""
+		
+		value = self.acquire_settings.get("queue-host-limit")
+		
+		return value if value is not None else -1
+	
+	@property
+	def AcquireQueueMode(self):
+		"""
+		Returns the acquire queue mode ("host" for one connection per
+		host, "access" for one per access method), or an empty string
+		if APT's default is used.
+		"""
+		
+		return self.acquire_settings.get("queue-mode") or ""
+	
+	@property
+	def BackgroundPrefetch(self):
+		"""
+		Returns True if the marked updates are fetched in background,
+		False if not.
+		"""
+		
+		return bool(self.acquire_settings.get("background-prefetch"))
+	
+	@property
+	def DownloadRateLimit(self):
+		"""
+		Returns the bandwidth limit of the refresh, fetch and prefetch
+		operations, in bytes per second (0 for no limit).
+		
+		Changes apply to running transfers too.
+		"""
+		
+		return self.acquire_settings.get("rate-limit") or 0
+	
+	def get_rate_limit(self):
+		"""
+		Returns the bandwidth limit of the running operation, in bytes
+		per second (0 for no limit).
+		"""
+		
+		return self.acquire_settings.effective("rate-limit") or 0
+	
+	def store_property(self, name, value):
+		"""
+		Stores the acquire settings changed with Set().
+		
+		-1 and the empty string restore APT's default.
+		"""
+		
+		settings = {
+			"AcquirePipelineDepth" : "pipeline-depth",
+			"AcquireQueueHostLimit" : "queue-host-limit",
+			"AcquireQueueMode" : "queue-mode",
+			"BackgroundPrefetch" : "background-prefetch",
+			"DownloadRateLimit" : "rate-limit",
+		}
+		
+		if not name in settings:
+			raise Exception("Property %s is read-only" % name)
+		
+		self.acquire_settings.set(
+			settings[name],
+			value if not value in (-1, "") else None
+		)
+		
+		if name == "BackgroundPrefetch":
+			if value:
+				self.queue_prefetch()
+			else:
+				with self.prefetch_lock:
+					self.prefetch_progress.paused = True
+		
+		# Notify the change
+		self.schedule_properties_changed()
+	
+	def get_transfer_stats(self):
+		"""
+		Returns the TransferStats of the running refresh or fetch, or
+		None if there isn't one.
+		"""
+		
+		if self.refreshing:
+			return updates.cache_acquire_progress.stats
+		elif self.downloading:
+			return updates.packages_acquire_progress.stats
+		
+		return None
+	
 	@property
 	def CurrentDownloadRate(self):
 		"""
 		Returns the current download rate, or an empty string.
 		"""
 		
-		if not self.refreshing and not self.downloading:
+		stats = self.get_transfer_stats()
+		if stats is None:
 			return ""
 		
-		return size_to_str(
-			updates.cache_acquire_progress.current_cps
-			if self.refreshing else
-			updates.packages_acquire_progress.current_cps
-		) + "B/s"
+		return size_to_str(stats.rate) + "B/s"
 	
 	@property
 	def CurrentDownloadETA(self):
 		"""
-		Returns the current download ETA, or an empty string.
+		Returns the time left to complete the current download, or an
+		empty string.
 		"""
 		
-		if not self.refreshing and not self.downloading:
+		stats = self.get_transfer_stats()
+		if stats is None:
 			return ""
 		
-		try:
-			eta = int(
-				updates.cache_acquire_progress.total_bytes / updates.cache_acquire_progress.current_cps
-				if self.refreshing else
-				updates.packages_acquire_progress.total_bytes / updates.packages_acquire_progress.current_cps
-			)
-		except ZeroDivisionError:
+		eta = stats.eta
+		if eta is None:
 			return ""
 		
 		minutes = math.floor(eta / 60)
@@ -625,52 +1477,302 @@ class Updates:
 			"%sh " % hours if hours > 0 else "",
 			"%sm" % minutes if minutes > 0 or hours > 0 else "< 1m"
 		)
+	
+	@property
+	def CurrentDownloadRateBytes(self):
+		"""
+		Returns the current (smoothed) download rate in bytes per second,
+		or 0.
+		"""
+		
+		stats = self.get_transfer_stats()
 		
+		return float(stats.rate) if stats is not None else 0.0
+	
+	@property
+	def CurrentDownloadETASeconds(self):
+		"""
+		Returns the seconds left to complete the current download, or -1
+		if not known.
+		"""
+		
+		stats = self.get_transfer_stats()
+		eta = stats.eta if stats is not None else None
+		
+		return int(math.ceil(eta)) if eta is not None else -1
+	
+	@property
+	def CurrentDownloadedBytes(self):
+		"""
+		Returns the bytes transferred by the current download, or 0.
+		"""
+		
+		stats = self.get_transfer_stats()
+		
+		return float(stats.current_bytes) if stats is not None else 0.0
+	
+	@property
+	def CurrentDownloadTotalBytes(self):
+		"""
+		Returns the bytes to transfer with the current download, or 0.
+		"""
+		
+		stats = self.get_transfer_stats()
+		
+		return float(stats.total_bytes) if stats is not None else 0.0
 	
-	@channels.common.thread()
 	@channels.actions.action(
-		root_required=True,
-		polkit_privilege="org.semplicelinux.channels.check-updates",
-		command="updates-refresh",
-		help="Refreshes the package cache.",
+		command=None,
+		out_signature="a(dd)a(sdb)"
 	)
-	def Refresh(self):
+	def GetTransferStatistics(self):
 		"""
-		Refreshes the package cache.
+		Returns the statistics of the current (or last) download:
+		
+		 - the rate history, as (seconds since start, bytes per second)
+		   structs
+		 - the duration of the last fetched items, as (description,
+		   seconds, failed) structs
 		"""
 		
+		# The running download is always the last started one
+		stats = max(
+			(
+				updates.cache_acquire_progress.stats,
+				updates.packages_acquire_progress.stats
+			),
+			key=lambda x: x.started or 0
+		)
 		
-		self.cache_operation_lock.acquire()
+		with stats.lock:
+			return list(stats.rate_history), list(stats.item_durations)
+	
+	@property
+	def JobQueueDepth(self):
+		"""
+		Returns the number of queued jobs.
+		"""
+		
+		return channels.common.job_queue.depth
+	
+	@channels.actions.action(
+		command=None,
+		out_signature="a(iss)"
+	)
+	def GetJobs(self):
+		"""
+		Returns the id, the name and the state ("queued", "running", "done"
+		or "failed") of every queued, running and recently finished job.
+		"""
 		
-		# Clear
+		return channels.common.job_queue.get_jobs()
+	
+	def _refresh(self, settings=None):
+		"""
+		Refreshes the package cache, with the given acquire settings on
+		top of the service ones. Run by the cache scheduler.
+		"""
+		
+		# Clear, the update list describes the previous cache
 		updates.clear()
-		print("CHanged is %s" % updates.changed)
+		self.accounting.clear()
+		self.package_states = {}
+		self.package_names = {}
+		self.update_list = []
 		
 		try:
-			updates.update()
+			with self.acquire_settings.override(settings), get_apt_duration("refresh").time():
+				updates.update()
 		except:
 			# FIXME: Should handle them
 			pass
 		
+		self.queue_prefetch()
+	
+	@channels.actions.action(
+		root_required=True,
+		polkit_privilege="org.semplicelinux.channels.check-updates",
+		command=None
+	)
+	def Refresh(self):
+		"""
+		Refreshes the package cache.
+		
+		The refresh is queued with a background priority, but the
+		operations queued after it wait for it, as it clears the marks.
+		"""
+		
+		self.cache_scheduler.submit(
+			"refresh",
+			self._refresh,
+			priority=PRIORITY_BACKGROUND,
+			key="refresh",
+			barrier=True
+		)
+	
+	@channels.actions.action(
+		root_required=True,
+		polkit_privilege="org.semplicelinux.channels.check-updates",
+		command="updates-refresh",
+		help="Refreshes the package cache. Acquire settings can be given as name=value (pipeline-depth, queue-host-limit, queue-mode, rate-limit).",
+		in_signature="as",
+		cli_group_last=True
+	)
+	def RefreshWithSettings(self, settings=()):
+		"""
+		Like Refresh(), but using the given acquire settings (see
+		FetchWithSettings()) for this operation only.
+		"""
+		
+		# Validate now, so that errors are sent back to the caller
+		settings = parse_options(settings)
+		
+		self.cache_scheduler.submit(
+			"refresh",
+			self._refresh,
+			(settings,),
+			priority=PRIORITY_BACKGROUND,
+			key="refresh",
+			barrier=True
+		)
+	
+	def _fetch(self, settings=None):
+		"""
+		Fetches the updates, with the given acquire settings on top of
+		the service ones.
+		"""
+		
+		if CURRENT_HANDLER == "cli":
+			self.CheckUpdates(True, False) # FIXME
+		
+		with self.prefetch_inhibited(), self.acquire_settings.override(settings):
+			with get_apt_duration("fetch").time():
+				updates.fetch()
+	
+	def _prefetch(self):
+		"""
+		Fetches the marked archives in the APT archive cache, so that
+		a later Fetch() or Install() finds them there. Run by the cache
+		scheduler, with a background priority.
+		"""
+		
+		cache = getattr(updates, "cache", None)
+		
+		with self.prefetch_lock:
+			if (
+				cache is None or
+				self.prefetch_inhibitors > 0 or
+				self.downloading or
+				self.installing or
+				not self.BackgroundPrefetch
+			):
+				return
+			
+			self.prefetch_progress.paused = False
+			self.prefetch_stopped.clear()
+			self.prefetching = True
+		
+		try:
+			with self.acquire_settings.override(), get_apt_duration("prefetch").time():
+				cache.fetch_archives(progress=self.prefetch_progress)
+		except apt.cache.FetchCancelledException:
+			logger.debug("Background prefetch paused")
+			
+			# Resume after the operations that paused us
+			with self.prefetch_lock:
+				resume = self.prefetch_inhibitors == 0
+			
+			if resume:
+				self.queue_prefetch()
+		except Exception as err:
+			logger.warning("Background prefetch failed: %s" % err)
+		finally:
+			self.prefetching = False
+			self.prefetch_stopped.set()
+	
+	def queue_prefetch(self):
+		"""
+		Queues a background prefetch on the cache scheduler, if enabled.
+		
+		The prefetch is paused (and queued again) as soon as another
+		operation is queued.
+		"""
+		
+		if CURRENT_HANDLER != "DBus" or not self.BackgroundPrefetch:
+			return
+		
+		def pause():
+			with self.prefetch_lock:
+				self.prefetch_progress.paused = True
 		
-		self.cache_operation_lock.release()
+		self.cache_scheduler.submit(
+			"prefetch",
+			self._prefetch,
+			priority=PRIORITY_BACKGROUND,
+			key="prefetch",
+			preempt=pause
+		)
+	
+	@contextlib.contextmanager
+	def prefetch_inhibited(self):
+		"""
+		Context manager that pauses the background prefetch (waiting
+		for it to release the APT locks) and resumes it at the end.
+		"""
+		
+		with self.prefetch_lock:
+			self.prefetch_inhibitors += 1
+			self.prefetch_progress.paused = True
+		
+		# Outside of the lock, which the prefetch needs to stop
+		self.prefetch_stopped.wait(PREFETCH_STOP_TIMEOUT)
+		
+		try:
+			yield
+		finally:
+			with self.prefetch_lock:
+				self.prefetch_inhibitors -= 1
+			
+			self.queue_prefetch()
 	
 	@channels.common.thread()
 	@channels.actions.action(
 		root_required=True,
 		polkit_privilege="org.semplicelinux.channels.fetch-updates",
-		command="updates-fetch",
-		help="Fetches the updates."
+		command=None
 	)
 	def Fetch(self):
 		"""
 		Fetches the updates.
 		"""
 		
-		if CURRENT_HANDLER == "cli":
-			self.CheckUpdates(True, False) # FIXME
+		self._fetch()
+	
+	@channels.actions.action(
+		root_required=True,
+		polkit_privilege="org.semplicelinux.channels.fetch-updates",
+		command="updates-fetch",
+		help="Fetches the updates. Acquire settings can be given as name=value (pipeline-depth, queue-host-limit, queue-mode, rate-limit).",
+		in_signature="as",
+		cli_group_last=True
+	)
+	def FetchWithSettings(self, settings=()):
+		"""
+		Fetches the updates, using the given acquire settings for this
+		operation only.
 		
-		updates.fetch()
+		Every setting is a "name=value" string, where name is one of
+		pipeline-depth, queue-host-limit, queue-mode and rate-limit
+		(in bytes per second).
+		"""
+		
+		# Validate now, so that errors are sent back to the caller
+		settings = parse_options(settings)
+		
+		if CURRENT_HANDLER == "DBus":
+			channels.common.job_queue.submit(self._fetch, (settings,), name="fetch")
+		else:
+			self._fetch(settings)
 
 	@channels.common.thread()
 	@channels.actions.action(
@@ -696,8 +1798,13 @@ class Updates:
 				get_user(sender)
 			)
 
-		if updates.fetch():
-			updates.install() # Do not launch another useless thread
+		with self.prefetch_inhibited():
+			with self.acquire_settings.override(), get_apt_duration("fetch").time():
+				fetched = updates.fetch()
+			
+			if fetched:
+				with get_apt_duration("install").time():
+					updates.install() # Do not launch another useless thread
 	
 	@channels.actions.action(
 		polkit_privilege="org.semplicelinux.channels.fetch-updates",
@@ -738,7 +1845,8 @@ class Updates:
 			)
 
 		print ("INSTALLING")
-		updates.install()
+		with self.prefetch_inhibited(), get_apt_duration("install").time():
+			updates.install()
 	
 	@channels.actions.action(
 		#polkit_privilege="org.semplicelinux.channels.enable-channel",
@@ -751,7 +1859,65 @@ class Updates:
 		
 		updates.clear()
 	
-	@channels.common.thread()
+	def _check_updates(self, dist_upgrade, force, bulk):
+		"""
+		Marks the package for (dist-)upgrade and stores the update list.
+		Run by the cache scheduler.
+		
+		If bulk is False, UpdateFound is fired for every update.
+		If bulk is True, the update list is sent with UpdatesFound, in
+		chunks of UPDATES_CHUNK_SIZE updates.
+		"""
+		
+		if CURRENT_HANDLER == "DBus": self.UpdateCheckStarted()
+
+		if not updates.changed or force:
+			if not updates.mark_for_upgrade(dist_upgrade):
+				if CURRENT_HANDLER == "DBus":
+					self.UpdateCheckFailed()
+				return
+		
+		if CURRENT_HANDLER == "DBus":
+			update_list = []
+			
+			def on_update_found(id, name, version, reason, status, size):
+				update_list.append((id, name, version, reason, status, str(size)))
+				if not bulk:
+					self.UpdateFound(id, name, version, reason, status, size)
+			
+			def on_finished():
+				self.update_list = update_list
+				if bulk:
+					for i in range(0, len(update_list), UPDATES_CHUNK_SIZE):
+						self.UpdatesFound(update_list[i:i+UPDATES_CHUNK_SIZE])
+				self.UpdateCheckStopped()
+			
+			updates.get_changes(on_update_found, finish_callback=on_finished)
+			
+			self.package_states = self.get_package_states()
+			
+			# Rebuild the accounting
+			self.package_names = {update[0]:update[1] for update in update_list}
+			self.accounting.clear()
+			self.account_packages()
+			
+			self.queue_prefetch()
+	
+	def _queue_check_updates(self, dist_upgrade, force, bulk):
+		"""
+		Queues an update check on the cache scheduler.
+		
+		Queued checks with the same mode are merged.
+		"""
+		
+		self.cache_scheduler.submit(
+			"check-updates",
+			self._check_updates,
+			(dist_upgrade, force, bulk),
+			key=("check-updates", dist_upgrade, bulk),
+			merge=lambda old, new: (old[0], old[1] or new[1], old[2])
+		)
+	
 	@channels.actions.action(
 		#polkit_privilege="org.semplicelinux.channels.enable-channel",
 		command=None,
@@ -770,48 +1936,262 @@ class Updates:
 		has been ran before.
 		"""
 		
-		self.cache_operation_lock.acquire()
+		self._queue_check_updates(dist_upgrade, force, False)
+	
+	@channels.actions.action(
+		command=None,
+		in_signature="bb"
+	)
+	def CheckUpdatesBulk(self, dist_upgrade, force):
+		"""
+		Like CheckUpdates(), but the whole update list is sent with
+		UpdatesFound (in a few large chunks) rather than with an
+		UpdateFound signal for every update.
+		"""
 		
-		if CURRENT_HANDLER == "DBus": self.UpdateCheckStarted()
-
-		if not updates.changed or force:
-			if not updates.mark_for_upgrade(dist_upgrade):
-				if CURRENT_HANDLER == "DBus":
-					self.UpdateCheckFailed()
-					self.cache_operation_lock.release()
-				return
+		self._queue_check_updates(dist_upgrade, force, True)
+	
+	@channels.actions.action(
+		command=None,
+		out_signature="a(isssss)"
+	)
+	def GetUpdates(self):
+		"""
+		Returns the update list found by the last CheckUpdates() or
+		CheckUpdatesBulk() call.
 		
-		if CURRENT_HANDLER == "DBus":
-			updates.get_changes(self.UpdateFound, finish_callback=self.UpdateCheckStopped)
+		Every update is an (id, name, version, reason, status, size)
+		struct.
+		"""
 		
-		self.cache_operation_lock.release()
+		return self.update_list
+	
+	def _change_status(self, changes):
+		"""
+		Marks the packages with the given (id, reason) changes, in order.
+		Run by the cache scheduler.
+		"""
+		
+		if self.downloading:
+			# Do not do anything if downloading
+			return
+		
+		# Group the marks in an apt action group, so that the
+		# dependency cache is cleaned up once, at the end.
+		cache = getattr(updates, "cache", None)
+		with (cache.actiongroup() if cache is not None else contextlib.nullcontext()):
+			for id, reason in changes:
+				updates.change_status(id, reason)
+		
+		# Report only the differences with the previous state
+		previous, self.package_states = self.package_states, self.get_package_states()
+		
+		delta = [
+			(package, state)
+			for package, state in sorted(self.package_states.items())
+			if previous.get(package) != state
+		] + [
+			(package, "keep")
+			for package in sorted(previous)
+			if not package in self.package_states
+		]
+		
+		for package, state in delta:
+			self.PackageStatusChanged(package, state)
+		
+		if delta:
+			self.PackageStatusesChanged(delta)
+		
+		self.account_packages(
+			[id for id, reason in changes] +
+			[package for package, state in delta]
+		)
+	
+	def get_package_states(self):
+		"""
+		Returns a dictionary that maps the id of every package changed
+		by the user to its reason.
+		"""
+		
+		states = {}
+		
+		def on_package_status(id, reason):
+			states[id] = reason
+		
+		updates.get_user_changes(callback=on_package_status)
+		
+		return states
+	
+	def get_package_contribution(self, package, cached_archives=None):
+		"""
+		Returns a (download, space) tuple with the contribution of
+		the given apt.Package to the required download and disk space,
+		or None if it's not marked.
+		
+		Archives already in APT's archive cache are not downloaded
+		again, and don't count (see is_archive_cached()).
+		"""
+		
+		installed_size = package.installed.installed_size if package.installed else 0
+		
+		if package.marked_delete:
+			return 0, -installed_size
+		elif package.marked_install or package.marked_upgrade or package.marked_downgrade or package.marked_reinstall:
+			candidate = package.candidate
+			return (
+				0 if is_archive_cached(candidate, cached_archives) else candidate.size,
+				candidate.installed_size - installed_size
+			)
+		
+		return None
+	
+	def account_packages(self, ids=None):
+		"""
+		Updates the accounting with the current contribution of the
+		given packages (ids in the update list), or rebuilds it for the
+		whole update list if `ids` is None.
+		
+		The accounting is exact only if every marked package is
+		accounted (checked against the depcache counts). When the
+		resolver changed other packages, the whole update list is read
+		again; if some marked packages are still missing (they are not
+		in the update list), the totals are computed from scratch.
+		"""
+		
+		cache = getattr(updates, "cache", None)
+		
+		if cache is None:
+			contributions = {}
+			exact = False
+		else:
+			marked = cache._depcache.inst_count + cache._depcache.del_count
+			
+			if ids is not None:
+				contributions = {}
+				removed = []
+				for id in set(ids):
+					name = self.package_names.get(id)
+					contribution = (
+						self.get_package_contribution(cache[name])
+						if name is not None and name in cache else
+						None
+					)
+					if contribution is not None:
+						contributions[id] = (name,) + contribution
+					else:
+						removed.append(id)
+				
+				if self.accounting.exact and self.accounting.apply(contributions, removed, marked):
+					return
+			
+			# Rebuild
+			cached_archives = get_cached_archives()
+			
+			contributions = {}
+			for id, name in self.package_names.items():
+				contribution = (
+					self.get_package_contribution(cache[name], cached_archives)
+					if name in cache else
+					None
+				)
+				if contribution is not None:
+					contributions[id] = (name,) + contribution
+			
+			exact = len(contributions) == marked
+		
+		if not exact:
+			# Computed before the accounting is marked as not exact,
+			# so that readers always find consistent totals
+			self.update_infos = updates.get_update_infos()
+		
+		self.accounting.update(contributions, exact)
 	
-	@channels.common.thread()
 	@channels.actions.action(
 		polkit_privilege="org.semplicelinux.channels.change-package-status",
 		command=None,
 		in_signature="is",
 		#out_signature="b"
 	)
-	def ChangeStatus(self, id, reason):
+	def ChangeStatus(self, id, reason, sender):
 		"""
 		Marks the package matching the given id with the given reason.
 		
 		Note: other packages may be affected by this actions. For every
-		change made, the PackageStatusChanged() signal is fired.
+		change made, the PackageStatusChanged() signal is fired; the
+		whole set of changes is then sent with PackageStatusesChanged().
+		
+		The change is queued with an interactive priority, so that it
+		runs before queued background operations. Changes made by the
+		same sender while a previous one is queued are merged with it
+		in a single batch, as with ChangeStatusMany().
+		"""
+		
+		self.queue_change_status([(id, reason)], sender)
+	
+	@channels.actions.action(
+		polkit_privilege="org.semplicelinux.channels.change-package-status",
+		command=None,
+		in_signature="a(is)"
+	)
+	def ChangeStatusMany(self, changes, sender):
+		"""
+		Marks the packages with the given (id, reason) changes, in order.
+		
+		The changes are applied in a single batch: the dependency cache
+		is cleaned up, and the changes are reported, only once.
+		"""
+		
+		self.queue_change_status([(int(id), str(reason)) for id, reason in changes], sender)
+	
+	def queue_change_status(self, changes, sender):
+		"""
+		Queues the given (id, reason) changes.
+		
+		Changes of the same sender are merged in the queued batch, if
+		any, preserving their order.
 		"""
 		
 		if self.downloading:
 			# Do not do anything if downloading
 			return
 		
-		self.cache_operation_lock.acquire()
+		self.cache_scheduler.submit(
+			"change-status",
+			self._change_status,
+			(changes,),
+			priority=PRIORITY_INTERACTIVE,
+			key=("change-status", sender),
+			merge=lambda queued, new: (queued[0] + new[0],)
+		)
+	
+	@channels.actions.action(
+		command=None,
+		out_signature="a(isis)"
+	)
+	def GetCacheOperations(self):
+		"""
+		Returns the id, the name, the priority and the state ("queued",
+		"running", "done", "failed" or "cancelled") of every queued,
+		running and recently finished cache operation.
+		"""
 		
-		updates.change_status(id, reason)
+		return self.cache_scheduler.get_operations()
+	
+	@channels.actions.action(
+		polkit_privilege="org.semplicelinux.channels.check-updates",
+		command=None,
+		in_signature="i",
+		out_signature="b"
+	)
+	def CancelCacheOperation(self, id):
+		"""
+		Cancels the given queued cache operation.
 		
-		updates.get_user_changes(callback=self.PackageStatusChanged)
+		Returns True if it has been cancelled, False if it's not queued
+		(anymore).
+		"""
 		
-		self.cache_operation_lock.release()
+		return self.cache_scheduler.cancel(id)
 	
 	@channels.actions.action(
 		command=None,
@@ -820,15 +2200,46 @@ class Updates:
 	def GetUpdateInfos(self):
 		"""
 		Returns useful update informations.
+		
+		While cache operations are running, the last consistent
+		informations are returned.
+		"""
+		
+		required_download, required_space = self.get_update_totals()
+		
+		return size_to_str(required_download) + "B", size_to_str(required_space) + "B"
+	
+	@channels.actions.action(
+		command=None,
+		out_signature="ssa(isxx)"
+	)
+	def GetUpdateInfosBreakdown(self):
+		"""
+		Like GetUpdateInfos(), but returns too the contribution of every
+		marked package, as (id, name, download bytes, space bytes) structs.
+		
+		The breakdown is empty when it's not available.
 		"""
 		
-		if self.cache_operation_lock.locked():
-			return "0B", "0B"
+		required_download, required_space = self.get_update_totals()
 		
-		self.cache_operation_lock.acquire()
+		return (
+			size_to_str(required_download) + "B",
+			size_to_str(required_space) + "B",
+			self.accounting.get_breakdown() if self.accounting.exact else []
+		)
+	
+	def get_update_totals(self):
+		"""
+		Returns the (required download, required space) tuple.
 		
-		required_download, required_space = updates.get_update_infos()
+		The incremental accounting is used when it's exact, otherwise
+		the last totals computed from scratch are returned. Both are
+		kept by the cache operations, so the cache (which may be in use)
+		is never read here.
+		"""
 		
-		self.cache_operation_lock.release()
+		if self.accounting.exact:
+			return self.accounting.get_totals()
 		
-		return size_to_str(required_download) + "B", size_to_str(required_space) + "B"
+		return self.update_infos
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# channels - Update channels management front-end
+# Copyright (C) 2015  Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# Authors:
+#    Eugenio "g7" Paolantonio <me@medesimo.eu>
+#
+
+import os
+
+import logging
+
+from gi.repository import GLib, Gio
+
+import channels.common
+from channels.snapshot import get_watched_paths
+
+logger = logging.getLogger(__name__)
+
+class DiscoveryWatcher:
+	"""
+	A DiscoveryWatcher monitors the channel definitions and the apt
+	sources (using inotify through GIO) and keeps the discovery cache
+	of a long-running service up-to-date.
+	
+	Directories are watched recursively, like the discovery snapshot
+	fingerprint walks them. The discovery cache is refreshed on the
+	shared job queue, off the main loop.
+	"""
+	
+	def __init__(self, on_changed, paths=None, delay=1):
+		"""
+		Initializes the watcher.
+		
+		`on_changed` is called (from a worker thread) with the sorted
+		list of changed entries every time the discovery cache changes.
+		
+		`paths` defaults to the ones that invalidate the discovery
+		snapshot (see channels.snapshot.get_watched_paths()).
+		
+		`delay` is the number of seconds to wait before refreshing, so
+		that a burst of file changes (e.g. an apt sources rewrite)
+		results in a single refresh.
+		"""
+		
+		self.on_changed = on_changed
+		self.delay = delay
+		
+		self.timeout = 0
+		
+		if paths is None:
+			paths = get_watched_paths() or []
+		
+		# path -> Gio.FileMonitor
+		self.monitors = {}
+		for path in paths:
+			if os.path.isdir(path):
+				self.watch_tree(path)
+			else:
+				self.watch(path)
+	
+	def watch(self, path):
+		"""
+		Watches the given file or directory (not recursively).
+		"""
+		
+		if path in self.monitors:
+			return
+		
+		gfile = Gio.File.new_for_path(path)
+		try:
+			monitor = (
+				gfile.monitor_directory(Gio.FileMonitorFlags.NONE, None)
+				if not os.path.isfile(path) else
+				gfile.monitor_file(Gio.FileMonitorFlags.NONE, None)
+			)
+		except GLib.Error as err:
+			logger.warning("Unable to watch %s: %s" % (path, err))
+			return
+		
+		monitor.connect("changed", self.on_file_changed)
+		self.monitors[path] = monitor
+	
+	def watch_tree(self, path):
+		"""
+		Watches the given directory and every directory below it.
+		"""
+		
+		self.watch(path)
+		
+		for directory, dirs, files in os.walk(path):
+			for name in dirs:
+				self.watch(os.path.join(directory, name))
+	
+	def on_file_changed(self, monitor, gfile, other_file, event_type):
+		"""
+		Fired when a watched file changed.
+		"""
+		
+		if event_type in (
+			Gio.FileMonitorEvent.ATTRIBUTE_CHANGED,
+			Gio.FileMonitorEvent.PRE_UNMOUNT,
+			Gio.FileMonitorEvent.UNMOUNTED
+		):
+			return
+		
+		path = gfile.get_path()
+		logger.debug("%s changed" % path)
+		
+		if event_type == Gio.FileMonitorEvent.CREATED and os.path.isdir(path):
+			# New subdirectory
+			self.watch_tree(path)
+		elif event_type == Gio.FileMonitorEvent.DELETED and path in self.monitors:
+			self.monitors.pop(path).cancel()
+		
+		self.schedule()
+	
+	def schedule(self):
+		"""
+		(Re)schedules the refresh.
+		"""
+		
+		if self.timeout > 0:
+			GLib.source_remove(self.timeout)
+		self.timeout = GLib.timeout_add_seconds(self.delay, self.on_timeout_elapsed)
+	
+	def on_timeout_elapsed(self):
+		"""
+		Fired when the delay elapsed. Queues the refresh of the
+		discovery cache.
+		"""
+		
+		self.timeout = 0
+		
+		try:
+			channels.common.job_queue.submit(self.refresh, name="discovery-refresh")
+		except channels.common.JobQueueFull:
+			# Try again later
+			self.schedule()
+		
+		return False
+	
+	def refresh(self):
+		"""
+		Refreshes the discovery cache. Run by the job queue.
+		"""
+		
+		try:
+			changed = channels.common.refresh_discovery()
+		except Exception as err:
+			logger.error("Unable to refresh the discovery cache: %s" % err)
+			return
+		
+		if changed:
+			logger.info("Discovery cache refreshed, changed: %s" % ", ".join(changed))
+			self.on_changed(changed)
+	
+	def cancel(self):
+		"""
+		Stops watching.
+		"""
+		
+		if self.timeout > 0:
+			GLib.source_remove(self.timeout)
+			self.timeout = 0
+		
+		for monitor in self.monitors.values():
+			monitor.cancel()
+		
+		self.monitors = {}